@@ -0,0 +1,347 @@
+# ----------------------------------------------------------------------
+#
+#    Power Monitoring (Basic solution) -- This digital solution measures,
+#    reports and records both AC power and current consumed by an electrical 
+#    equipment, so that its energy consumption can be understood and 
+#    taken action upon. This version comes with one current transformer 
+#    clamp of 20A that is buckled up to the electric line the equipment 
+#    is connected to. The solution provides a Grafana dashboard that 
+#    displays current and power consumption, and an InfluxDB database 
+#    to store timestamp, current and power. 
+#
+#    Copyright (C) 2022  Shoestring and University of Cambridge
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3 of the License.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see https://www.gnu.org/licenses/.
+#
+# ----------------------------------------------------------------------
+
+# End-to-end pipeline benchmark: CurrentMeasureBuildingBlock -> ZMQ -> MQTTServiceWrapper -> MQTT broker.
+#
+# Runs the real building blocks (as separate processes, exactly as main.py does) against a synthetic ADC driver
+# and either an in-process stand-in broker or a real one, then reports sustained messages/s, sample-to-publish
+# latency percentiles and CPU / RSS per process as JSON so results can be compared across releases.
+#
+#   python benchmark/pipeline.py --duration 20 --label v1.3 --output results.json
+#   python benchmark/pipeline.py --set sampling.sample_interval=0.001 --set sampling.mode="rms"
+#   python benchmark/pipeline.py --broker localhost:1883
+#   python benchmark/pipeline.py --set deployment.mode="threads"   (one process, reported as "pipeline")
+#   python benchmark/pipeline.py --set influx.enabled=true --set influx.flush_interval=0.1   (direct InfluxDB writer)
+
+import argparse
+import datetime
+import gzip
+import http.server
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+
+import numpy as np
+import tomli
+
+code_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "code")
+sys.path.insert(0, code_dir)
+
+import main  # noqa: E402
+
+logger = logging.getLogger("benchmark")
+
+
+class StandInBroker(threading.Thread):
+    # Minimal MQTT 3.1.1 server - acknowledges CONNECT, PUBLISH (QoS 0/1) and PINGREQ and records every
+    # publish with its arrival time. Enough for the wrapper's paho client, nothing more.
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.port = self.server.getsockname()[1]
+        self.received = []
+
+    def run(self):
+        while True:
+            conn, _ = self.server.accept()
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        stream = conn.makefile('rb')
+        try:
+            self.serve(conn, stream)
+        except ConnectionError:
+            pass  # client went away
+        finally:
+            conn.close()
+
+    def serve(self, conn, stream):
+        while True:
+            header = stream.read(1)
+            if not header:
+                return
+            length, multiplier = 0, 1
+            while True:
+                byte = stream.read(1)[0]
+                length += (byte & 0x7F) * multiplier
+                multiplier *= 128
+                if not byte & 0x80:
+                    break
+            body = stream.read(length)
+
+            packet_type = header[0] >> 4
+            if packet_type == 1:  # CONNECT
+                conn.sendall(b'\x20\x02\x00\x00')
+            elif packet_type == 3:  # PUBLISH
+                arrival = time.time()
+                qos = (header[0] >> 1) & 0x03
+                topic_length = int.from_bytes(body[:2], 'big')
+                topic = body[2:2 + topic_length].decode()
+                position = 2 + topic_length
+                if qos:
+                    conn.sendall(b'\x40\x02' + body[position:position + 2])
+                    position += 2
+                self.received.append((arrival, topic, body[position:]))
+            elif packet_type == 12:  # PINGREQ
+                conn.sendall(b'\xd0\x00')
+            elif packet_type == 14:  # DISCONNECT
+                return
+
+
+class StandInInflux(threading.Thread):
+    # Minimal InfluxDB v2 write endpoint - answers 204 and records the reading lines of every write with its arrival
+    # time, as (arrival, path, body) like the brokers' publishes. Diagnostics measurements are left out.
+    def __init__(self, measurement):
+        super().__init__(daemon=True)
+        self.received = []
+        received = self.received
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, as the writer expects
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                arrival = time.time()
+                if self.headers.get('Content-Encoding') == "gzip":
+                    body = gzip.decompress(body)
+                lines = [line for line in body.split(b"\n") if line.startswith(measurement.encode())]
+                if lines:
+                    received.append((arrival, self.path, b"\n".join(lines)))
+                self.send_response(204)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def run(self):
+        self.server.serve_forever()
+
+
+class BrokerObserver:
+    # subscribes to a real broker and records publishes the same way as the stand-in
+    def __init__(self, host, port, topic):
+        import paho.mqtt.client as mqtt
+        self.received = []
+        self.client = mqtt.Client()
+        self.client.on_message = lambda _c, _u, msg: self.received.append((time.time(), msg.topic, msg.payload))
+        self.client.connect(host, port, 60)
+        self.client.subscribe(topic)
+        self.client.loop_start()
+
+
+def run_threaded(bbs):
+    # the whole pipeline in one child process, so that its CPU and RSS are measured apart from the benchmark's
+    main.start_building_blocks(bbs, "threads")
+    main.monitor_building_blocks(bbs)
+
+
+def process_stats(pid):
+    # cumulative CPU seconds and current RSS (kB) from /proc
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    rss = 0
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1])
+    return cpu, rss
+
+
+def decode_payload(payload):
+    # any of the mqtt.encoding formats, as a list of readings (batched messages hold several)
+    try:
+        message = json.loads(payload)
+    except (ValueError, UnicodeDecodeError):
+        try:
+            import msgpack
+            message = msgpack.unpackb(payload)
+        except Exception:
+            try:  # line protocol, only the timestamp is needed
+                message = [{"timestamp": int(line.rsplit(" ", 1)[1])} for line in payload.decode().split("\n")]
+            except (ValueError, IndexError, UnicodeDecodeError):
+                return []
+    return message if isinstance(message, list) else [message]
+
+
+def sample_timestamp(reading):
+    timestamp = reading.get('timestamp') if isinstance(reading, dict) else None
+    if isinstance(timestamp, int):
+        return timestamp / 1e9
+    if isinstance(timestamp, str):
+        return datetime.datetime.fromisoformat(timestamp).timestamp()
+    return None
+
+
+def apply_overrides(config, overrides):
+    # --set section.key=value, value parsed as JSON where possible
+    for override in overrides:
+        key, value = override.split('=', 1)
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        target = config
+        *sections, name = key.split('.')
+        for section in sections:
+            target = target.setdefault(section, {})
+        target[name] = value
+
+
+def benchmark_config(args):
+    with open(args.config, "rb") as f:
+        config = tomli.load(f)
+    config['adc']['adc_module'] = "testADC"
+    config['sampling']['sample_interval'] = 0.01
+    config['sampling']['sample_count'] = 1
+    config['sampling']['stats_interval'] = 0
+    config['mqtt']['reconnect']['initial'] = 0.1
+    config.setdefault('outbox', {})['path'] = ""  # the broker is local, nothing to store
+    apply_overrides(config, args.set)
+    return config
+
+
+def run(args):
+    config = benchmark_config(args)
+
+    if config.get('influx', {}).get('enabled', False):
+        broker = StandInInflux(config['mqtt'].get('measurement', "equipment_power_usage"))
+        broker.start()
+        config['influx']['url'] = broker.url
+    elif args.broker:
+        host, port = args.broker.rsplit(':', 1)
+        config['mqtt']['broker'], config['mqtt']['port'] = host, int(port)
+        broker = BrokerObserver(host, int(port), "#")
+    else:
+        broker = StandInBroker()
+        broker.start()
+        config['mqtt']['broker'], config['mqtt']['port'] = "127.0.0.1", broker.port
+
+    ring = main.create_waveform_ring(config)
+    bbs = main.create_building_blocks(config, ring)
+    launched = time.time()
+    if main.deployment_mode(config) == "threads":
+        processes = {"pipeline": multiprocessing.Process(target=run_threaded, args=(bbs,))}
+        processes["pipeline"].start()
+    else:
+        main.start_building_blocks(bbs)
+        processes = bbs
+    try:
+        time.sleep(args.warmup)
+        start = time.time()
+        first_received = len(broker.received)
+        cpu_start = {key: process_stats(process.pid)[0] for key, process in processes.items()}
+        rss_max = {key: 0 for key in processes}
+        while time.time() - start < args.duration:
+            time.sleep(0.5)
+            for key, process in processes.items():
+                rss_max[key] = max(rss_max[key], process_stats(process.pid)[1])
+        elapsed = time.time() - start
+        cpu_end = {key: process_stats(process.pid)[0] for key, process in processes.items()}
+        # readings only - diagnostics, aggregates and raw waveform publishes are not part of the throughput figures
+        received = [entry for entry in broker.received[first_received:]
+                    if not any(kind in entry[1] for kind in ("/diagnostics/", "/aggregate/", "/waveform/"))]
+        # launch to first reading at the broker
+        startup = next((entry[0] - launched for entry in broker.received
+                        if not any(kind in entry[1] for kind in ("/diagnostics/", "/aggregate/", "/waveform/"))), None)
+    finally:
+        for process in processes.values():
+            process.terminate()
+            process.join()
+        if ring is not None:
+            ring.close()
+            ring.unlink()
+
+    readings = 0
+    latencies = []
+    for arrival, _topic, payload in received:
+        for reading in decode_payload(payload):
+            readings += 1
+            sampled = sample_timestamp(reading)
+            if sampled is not None:
+                latencies.append((arrival - sampled) * 1000)
+    latencies = np.array(latencies)
+
+    return {
+        "label": args.label,
+        "run_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "broker": "stand-in influx" if isinstance(broker, StandInInflux) else args.broker or "stand-in",
+        "overrides": args.set,
+        "deployment": main.deployment_mode(config),
+        "duration_s": elapsed,
+        "startup_s": startup,
+        "messages": len(received),
+        "messages_per_second": len(received) / elapsed,
+        "readings": readings,
+        "readings_per_second": readings / elapsed,
+        "bytes_per_second": sum(len(payload) for _, _, payload in received) / elapsed,
+        "latency_ms": {
+            "p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p99": float(np.percentile(latencies, 99)) if len(latencies) else None,
+            "max": float(latencies.max()) if len(latencies) else None,
+        },
+        "processes": {
+            key: {
+                "cpu_percent": (cpu_end[key] - cpu_start[key]) / elapsed * 100,
+                "rss_max_kb": rss_max[key],
+            } for key in processes
+        },
+        "rss_total_kb": sum(rss_max.values()),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="measure -> wrapper -> MQTT pipeline benchmark")
+    parser.add_argument("--config", default=os.path.join(code_dir, "..", "config", "config.toml"))
+    parser.add_argument("--duration", type=float, default=10, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds discarded at the start")
+    parser.add_argument("--broker", help="host:port of a real MQTT broker, default is the in-process stand-in")
+    parser.add_argument("--set", action="append", default=[], metavar="SECTION.KEY=VALUE",
+                        help="config override, e.g. sampling.sample_interval=0.001 (repeatable)")
+    parser.add_argument("--label", default="", help="free text stored with the results, e.g. release tag")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)  # main configures INFO, which would log every message
+    results = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
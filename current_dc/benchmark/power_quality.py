@@ -0,0 +1,124 @@
+# ----------------------------------------------------------------------
+#
+#    Power Monitoring (Basic solution) -- This digital solution measures,
+#    reports and records both AC power and current consumed by an electrical 
+#    equipment, so that its energy consumption can be understood and 
+#    taken action upon. This version comes with one current transformer 
+#    clamp of 20A that is buckled up to the electric line the equipment 
+#    is connected to. The solution provides a Grafana dashboard that 
+#    displays current and power consumption, and an InfluxDB database 
+#    to store timestamp, current and power. 
+#
+#    Copyright (C) 2022  Shoestring and University of Cambridge
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3 of the License.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see https://www.gnu.org/licenses/.
+#
+# ----------------------------------------------------------------------
+
+# Power quality analytics benchmark: cost and accuracy of PowerMonitoringCalculation.spectrum_block (one FFT per
+# captured block) on a synthetic waveform with known harmonic content, replayed through the ReplayADC driver.
+#
+# Reports per block size the mean / p99 compute time, the share of the block's capture time that this uses (the
+# sampling budget - it has to stay well below 1) and the THD / fundamental error against the generated signal.
+#
+#   python benchmark/power_quality.py
+#   python benchmark/power_quality.py --sample-rate 5000 --block-sizes 500 1000 2000 --output pi4.json
+
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+code_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "code")
+sys.path.insert(0, code_dir)
+
+import calculate  # noqa: E402
+from adc import ReplayADC  # noqa: E402
+
+
+def run(args):
+    harmonics = [[3, 0.2], [5, 0.1], [7, 0.05]]
+    calculation = calculate.PowerMonitoringCalculation(
+        {"calculation": {"amplifier_gain": 1, "current_range": 20, "phases": 1, "voltage": 230}}, numeric=True)
+    expected_thd = math.sqrt(sum(relative ** 2 for _order, relative in harmonics)) * 100
+    expected_fundamental = args.amplitude / math.sqrt(2) * 20
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "power_quality.npy")
+        ReplayADC.generate(path, sample_rate=args.sample_rate, duration=args.duration, frequency=args.frequency,
+                           amplitude=args.amplitude, harmonics=harmonics, noise=0.002)
+        adc = ReplayADC.ADC({"adc": {"channel": 0, "replay_file": path, "replay_rate": 0}})
+
+        results = []
+        for block_size in args.block_sizes:
+            timings = []
+            thd = []
+            fundamental = []
+            for _ in range(args.blocks):
+                codes = adc.sample_block(block_size)
+                start = time.perf_counter()
+                harmonic_power, peak = calculation.spectrum_block(codes, adc.VoltsPerCode, args.sample_rate,
+                                                                  args.frequency, 15)
+                timings.append(time.perf_counter() - start)
+                rms_voltage = math.sqrt(calculation.mean_square_block(codes, adc.VoltsPerCode))
+                quality = calculation.power_quality(harmonic_power, peak, rms_voltage)
+                thd.append(quality['thd'])
+                fundamental.append(quality['harmonic_1'])
+            timings = np.array(timings[1:])  # the first block builds the cached window
+            block_seconds = block_size / args.sample_rate
+            results.append({
+                "block_size": block_size,
+                "block_ms": block_seconds * 1000,
+                "compute_ms": {"mean": float(timings.mean() * 1000), "p99": float(np.percentile(timings, 99) * 1000)},
+                "budget_fraction": float(timings.mean() / block_seconds),
+                "thd_percent": {"expected": expected_thd, "mean": float(np.mean(thd)), "max_error": float(
+                    np.max(np.abs(np.array(thd) - expected_thd)))},
+                "fundamental_a": {"expected": expected_fundamental, "mean": float(np.mean(fundamental))},
+            })
+
+    return {
+        "label": args.label,
+        "run_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "sample_rate": args.sample_rate,
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FFT power quality metrics benchmark")
+    parser.add_argument("--sample-rate", type=float, default=10000, help="synthetic samples per second")
+    parser.add_argument("--frequency", type=float, default=50, help="mains frequency of the synthetic signal")
+    parser.add_argument("--amplitude", type=float, default=1.0, help="peak volts of the fundamental")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of synthetic waveform generated")
+    parser.add_argument("--block-sizes", type=int, nargs="+", default=[500, 1000, 2000, 4000, 8000])
+    parser.add_argument("--blocks", type=int, default=200, help="blocks timed per block size")
+    parser.add_argument("--label", default="", help="free text stored with the results, e.g. release tag")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
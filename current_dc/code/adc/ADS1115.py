@@ -0,0 +1,117 @@
+# ----------------------------------------------------------------------
+#
+#    Power Monitoring (Basic solution) -- This digital solution measures,
+#    reports and records both AC power and current consumed by an electrical 
+#    equipment, so that its energy consumption can be understood and 
+#    taken action upon. This version comes with one current transformer 
+#    clamp of 20A that is buckled up to the electric line the equipment 
+#    is connected to. The solution provides a Grafana dashboard that 
+#    displays current and power consumption, and an InfluxDB database 
+#    to store timestamp, current and power. 
+#
+#    Copyright (C) 2022  Shoestring and University of Cambridge
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3 of the License.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see https://www.gnu.org/licenses/.
+#
+# ----------------------------------------------------------------------
+
+import logging
+import time
+
+import numpy as np
+import smbus2 as smbus
+
+try:
+    import RPi.GPIO as GPIO
+except ImportError:  # only needed when the ALERT/RDY pin is wired up
+    GPIO = None
+
+logger = logging.getLogger("main.measure.adc.ads1115")
+
+# register pointers
+REG_CONVERT = 0x00
+REG_CONFIG = 0x01
+REG_LOWTHRESH = 0x02
+REG_HITHRESH = 0x03
+
+# config register MSB - single-ended multiplexer settings (AINx vs GND), gain and mode
+MUX_SINGLE = [0x40, 0x50, 0x60, 0x70]
+PGA = {6.144: 0x00, 4.096: 0x02, 2.048: 0x04, 1.024: 0x06, 0.512: 0x08, 0.256: 0x0A}
+MODE_CONTIN = 0x00
+
+# config register LSB - data rate and comparator queue
+DATA_RATE = {8: 0x00, 16: 0x20, 32: 0x40, 64: 0x60, 128: 0x80, 250: 0xA0, 475: 0xC0, 860: 0xE0}
+CQUE_1CONV = 0x00
+CQUE_NONE = 0x03
+
+
+class ADS1115:
+    # Instance based ADS1115 driver running in continuous conversion mode.
+    # The config register is only written when the channel changes. Reads are paced by the ALERT/RDY
+    # pin when it is wired up, otherwise by the conversion period.
+    def __init__(self, bus=1, address=0x48, full_scale=4.096, data_rate=860, alert_pin=None):
+        self.bus = smbus.SMBus(bus)
+        self.address = address
+        self.pga = PGA[full_scale]
+        self.dr = DATA_RATE[data_rate]
+        self.VoltsPerCode = full_scale / 32768
+        self.conversion_period = 1 / data_rate
+        self.alert_pin = alert_pin
+
+        self.channel = None
+        self.next_ready = 0
+
+        if alert_pin is not None:
+            if GPIO is None:
+                raise RuntimeError("RPi.GPIO is required to use the ALERT/RDY pin")
+            # hi_thresh MSB set and lo_thresh MSB cleared turns ALERT/RDY into a conversion ready pulse
+            self.bus.write_i2c_block_data(self.address, REG_HITHRESH, [0x80, 0x00])
+            self.bus.write_i2c_block_data(self.address, REG_LOWTHRESH, [0x00, 0x00])
+            GPIO.setmode(GPIO.BCM)
+            GPIO.setup(alert_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        logger.info(f"ADS1115 at {hex(address)} on bus {bus}: {data_rate} SPS, +/-{full_scale}V")
+
+    def set_channel(self, channel):
+        if channel == self.channel:
+            return
+        cque = CQUE_NONE if self.alert_pin is None else CQUE_1CONV
+        config = [MUX_SINGLE[channel] | self.pga | MODE_CONTIN, self.dr | cque]
+        self.bus.write_i2c_block_data(self.address, REG_CONFIG, config)
+        self.channel = channel
+        # writing the config restarts conversion - leave time for the first one on the new channel
+        self.next_ready = time.perf_counter() + self.conversion_period
+
+    def wait_ready(self):
+        if self.alert_pin is not None:
+            timeout_ms = max(1, int(4000 * self.conversion_period))
+            if GPIO.wait_for_edge(self.alert_pin, GPIO.FALLING, timeout=timeout_ms) is None:
+                logger.warning("timed out waiting for ALERT/RDY")
+            return
+
+        now = time.perf_counter()
+        if now < self.next_ready:
+            time.sleep(self.next_ready - now)
+        self.next_ready = max(self.next_ready, now) + self.conversion_period
+
+    def read_raw(self, channel):
+        self.set_channel(channel)
+        self.wait_ready()
+        data = self.bus.read_i2c_block_data(self.address, REG_CONVERT, 2)
+        raw_adc = data[0] * 256 + data[1]
+        if raw_adc > 32767:
+            raw_adc -= 65536
+        return raw_adc
+
+    def read_block(self, channel, n):
+        read = self.read_raw
+        return np.fromiter((read(channel) for _ in range(n)), dtype=np.int16, count=n)
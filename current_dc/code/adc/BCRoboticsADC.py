@@ -25,17 +25,25 @@
 #
 # ----------------------------------------------------------------------
 
+import numpy as np
 from bcr_mcp3008 import MCP3008
 
 
 class ADC:
     def __init__(self, config):
-        self.adc = MCP3008(device=0)
+        self.adc = MCP3008(device=config['adc'].get('spi_device', 0))  # chip select, CE0 or CE1
         self.channel = config['adc']['channel']
         self.ADCMax = pow(2, 10) - 1
         self.ADCVoltage = 3.3
+        self.VoltsPerCode = self.ADCVoltage / self.ADCMax
 
-    def sample(self):
-        reading = self.adc.readData(self.channel)
+    def sample(self, channel=None):
+        reading = self.adc.readData(self.channel if channel is None else channel)
         voltage = (reading / self.ADCMax * self.ADCVoltage)
         return voltage
+
+    def sample_block(self, n, channel=None):
+        # raw 10-bit codes captured back-to-back
+        read = self.adc.readData
+        channel = self.channel if channel is None else channel
+        return np.fromiter((read(channel) for _ in range(n)), dtype=np.uint16, count=n)
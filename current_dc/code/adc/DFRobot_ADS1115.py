@@ -215,6 +215,18 @@ class ADS1115():
         raw_adc = int(float(raw_adc)*coefficient)
         return {'r' : raw_adc}
 
+    def read_raw(self):
+        '''!
+          @brief  Read the signed conversion code without scaling or delay.
+          @return raw  adc code
+        '''
+        global addr_G
+        data = bus.read_i2c_block_data(addr_G, ADS1115_REG_POINTER_CONVERT, 2)
+        raw_adc = data[0] * 256 + data[1]
+        if raw_adc > 32767:
+            raw_adc -= 65536
+        return raw_adc
+
     def read_voltage(self,channel):
         '''!
           @brief Reads the voltage of the specified channel.
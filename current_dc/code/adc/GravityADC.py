@@ -25,19 +25,76 @@
 #
 # ----------------------------------------------------------------------
 
+import threading
+import time
+
+import numpy as np
+
+from adc import DFRobot_ADS1115
 from adc.DFRobot_ADS1115 import ADS1115
+from adc.ADS1115 import ADS1115 as ContinuousADS1115
+
+# the DFRobot driver keeps the I2C address (and bus 1) in module globals - every address-select-and-transfer holds
+# this lock so that boards read concurrently (thread pool, capture threads) each talk to their own chip. The lock is
+# only held for the I2C transfers, conversion waits of different boards overlap
+dfrobot_lock = threading.Lock()
 
 
 class ADC:
     def __init__(self, config):
-        self.adc = ADS1115()
-        self.channel = config['adc']['channel']
+        adc_conf = config['adc']
+        self.channel = adc_conf['channel']
         self.ADCMax = 1024
         self.ADCVoltage = 1.024
-        self.I2CAddress = config['adc'].get('i2c_address', 0x48)
+        self.I2CAddress = adc_conf.get('i2c_address', 0x48)
+        self.CodeRange = (-32768, 32767)  # sample_block returns signed 16 bit conversion results
+        self.continuous = adc_conf.get('continuous', False)
+        if self.continuous:
+            self.adc = ContinuousADS1115(bus=adc_conf.get('i2c_bus', 1), address=self.I2CAddress,
+                                         full_scale=adc_conf.get('full_scale', 4.096),
+                                         data_rate=adc_conf.get('data_rate', 860),
+                                         alert_pin=adc_conf.get('alert_pin'))
+            self.VoltsPerCode = self.adc.VoltsPerCode
+        else:
+            self.adc = ADS1115()
+            self.VoltsPerCode = DFRobot_ADS1115.coefficient / 1000  # coefficient is mV per code
+            self.conversion_period = 1 / 128  # data rate the DFRobot driver configures
 
-    def sample(self):
-        self.adc.set_addr_ADS1115(self.I2CAddress)  # See the physical switch on the module and change accordingly
-        reading = self.adc.read_voltage(self.channel)['r']
+    def sample(self, channel=None):
+        if self.continuous:
+            return self.adc.read_raw(self.channel if channel is None else channel) * self.VoltsPerCode
+        self.configure(self.channel if channel is None else channel)
+        time.sleep(0.1)  # wait for the conversion, as read_voltage() does
+        with dfrobot_lock:
+            self.adc.set_addr_ADS1115(self.I2CAddress)
+            reading = self.adc.read_value()['r']
         voltage = (reading / self.ADCMax * self.ADCVoltage)
         return voltage
+
+    def sample_block(self, n, channel=None):
+        if self.continuous:
+            return self.adc.read_block(self.channel if channel is None else channel, n)
+
+        # set_single() leaves the ADS1115 converting continuously at 128 SPS - configure it once, then read the
+        # conversion register once per conversion period so that every code is a new conversion
+        self.configure(self.channel if channel is None else channel)
+        time.sleep(0.1)  # wait for the first conversion
+        return np.fromiter(self.paced_reads(n), dtype=np.int16, count=n)
+
+    def configure(self, channel):
+        with dfrobot_lock:
+            self.adc.set_addr_ADS1115(self.I2CAddress)  # See the physical switch on the module and change accordingly
+            self.adc.set_channel(channel)
+            self.adc.set_single()
+
+    def paced_reads(self, n):
+        next_ready = time.perf_counter()
+        for _ in range(n):
+            now = time.perf_counter()
+            if now < next_ready:
+                time.sleep(next_ready - now)
+            next_ready = max(next_ready, now) + self.conversion_period
+            with dfrobot_lock:
+                self.adc.set_addr_ADS1115(self.I2CAddress)
+                code = self.adc.read_raw()
+            yield code
@@ -27,20 +27,30 @@
 
 from grove.adc import ADC as GroveADC
 import logging
+import numpy as np
 
 logger = logging.getLogger("main.measure.adc.grove")
 
 class ADC:
     def __init__(self, config):
-        if config['computing'] and config['computing']['hardware'] == "Rock4C+":
+        if 'i2c_bus' in config['adc']:
+            self.adc = GroveADC(bus=config['adc']['i2c_bus'])
+        elif config['computing'] and config['computing']['hardware'] == "Rock4C+":
             self.adc = GroveADC(bus=7)
         else:
             self.adc = GroveADC()
         self.channel = config['adc']['channel']
         self.ADCMax = pow(2, 12) - 1
         self.ADCVoltage = 3.3
+        self.VoltsPerCode = self.ADCVoltage / self.ADCMax
 
-    def sample(self):
-        voltage = self.adc.read_voltage(self.channel) / 1000
+    def sample(self, channel=None):
+        voltage = self.adc.read_voltage(self.channel if channel is None else channel) / 1000
         logger.debug(f"v {voltage}")
         return voltage
+
+    def sample_block(self, n, channel=None):
+        # raw 12-bit codes captured back-to-back
+        read = self.adc.read_raw
+        channel = self.channel if channel is None else channel
+        return np.fromiter((read(channel) for _ in range(n)), dtype=np.uint16, count=n)
@@ -0,0 +1,126 @@
+# ----------------------------------------------------------------------
+#
+#    Power Monitoring (Basic solution) -- This digital solution measures,
+#    reports and records both AC power and current consumed by an electrical 
+#    equipment, so that its energy consumption can be understood and 
+#    taken action upon. This version comes with one current transformer 
+#    clamp of 20A that is buckled up to the electric line the equipment 
+#    is connected to. The solution provides a Grafana dashboard that 
+#    displays current and power consumption, and an InfluxDB database 
+#    to store timestamp, current and power. 
+#
+#    Copyright (C) 2022  Shoestring and University of Cambridge
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3 of the License.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see https://www.gnu.org/licenses/.
+#
+# ----------------------------------------------------------------------
+
+import logging
+import math
+import os
+import time
+
+import numpy as np
+
+logger = logging.getLogger("main.measure.adc.replay")
+
+
+def generate(path, sample_rate=10000, duration=60, frequency=50, amplitude=1.0, harmonics=(), noise=0.005,
+             load_profile=((1, 1.0),), bits=12, reference=3.3, channels=1, seed=0):
+    # writes a synthetic recording of mid-scale biased ADC codes to a .npy file, one column per channel.
+    # amplitude and noise are in volts, harmonics are [order, relative amplitude] pairs and load_profile is a
+    # repeating list of [seconds, load multiplier] steps (e.g. idle, inrush, running)
+    adc_max = pow(2, bits) - 1
+    total = int(sample_rate * duration)
+    rng = np.random.default_rng(seed)
+
+    step_ends = np.cumsum([step[0] for step in load_profile])
+    step_levels = np.array([step[1] for step in load_profile] + [load_profile[-1][1]], dtype=np.float64)
+    cycle = step_ends[-1]
+
+    codes = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint16, shape=(total, channels))
+    chunk = 1 << 20
+    for start in range(0, total, chunk):
+        t = np.arange(start, min(start + chunk, total)) / sample_rate
+        envelope = step_levels[np.searchsorted(step_ends, t % cycle, side='right')]
+        angle = 2 * math.pi * frequency * t
+        for channel in range(channels):
+            # channels are 120 degrees apart, as on a three phase supply
+            shift = 2 * math.pi / 3 * channel
+            wave = np.sin(angle - shift)
+            for order, relative in harmonics:
+                wave += relative * np.sin(order * (angle - shift))
+            volts = reference / 2 + amplitude * envelope * wave + rng.normal(0, noise, len(t))
+            codes[start:start + len(t), channel] = np.clip(np.rint(volts * adc_max / reference), 0, adc_max)
+    codes.flush()
+    logger.info(f"generated {duration}s synthetic waveform at {sample_rate} samples/s in {path}")
+
+
+class ADC:
+    # Replays a recorded (or generated) waveform file at a virtual sample rate, which can be faster than real time.
+    # The file is memory-mapped, block reads are views into it wherever they do not wrap around the end.
+    def __init__(self, config):
+        adc_conf = config['adc']
+        self.channel = adc_conf['channel']
+        self.path = adc_conf.get('replay_file', "replay_waveform.npy")
+        self.rate = adc_conf.get('replay_rate', 10000)  # samples per second delivered, 0 = as fast as possible
+        bits = adc_conf.get('replay_bits', 12)
+
+        self.ADCMax = pow(2, bits) - 1
+        self.ADCVoltage = adc_conf.get('replay_reference', 3.3)
+        self.VoltsPerCode = self.ADCVoltage / self.ADCMax
+
+        if not os.path.exists(self.path):
+            generate(self.path,
+                     sample_rate=adc_conf.get('replay_sample_rate', 10000),
+                     duration=adc_conf.get('replay_duration', 60),
+                     frequency=adc_conf.get('replay_frequency', 50),
+                     amplitude=adc_conf.get('replay_amplitude', 1.0),
+                     harmonics=adc_conf.get('replay_harmonics', []),
+                     noise=adc_conf.get('replay_noise', 0.005),
+                     load_profile=adc_conf.get('replay_load_profile', [[1, 1.0]]),
+                     bits=bits, reference=self.ADCVoltage,
+                     channels=adc_conf.get('replay_channels', 1))
+
+        self.codes = np.load(self.path, mmap_mode='r')
+        if self.codes.ndim == 1:
+            self.codes = self.codes.reshape(-1, 1)
+        self.position = 0
+        self.next_time = time.perf_counter()
+        logger.info(f"replaying {self.codes.shape[0]} samples x {self.codes.shape[1]} channels from {self.path}")
+
+    def wait(self, n):
+        # pace reads to the virtual sample rate
+        if self.rate <= 0:
+            return
+        now = time.perf_counter()
+        self.next_time = max(self.next_time, now - 1) + n / self.rate  # allow at most 1s of catch up
+        if self.next_time > now:
+            time.sleep(self.next_time - now)
+
+    def read(self, n, channel):
+        column = (self.channel if channel is None else channel) % self.codes.shape[1]
+        length = self.codes.shape[0]
+        start = self.position
+        self.position = (start + n) % length
+        if start + n <= length:
+            return np.asarray(self.codes[start:start + n, column])
+        return np.take(self.codes[:, column], np.arange(start, start + n), mode='wrap')
+
+    def sample(self, channel=None):
+        self.wait(1)
+        return int(self.read(1, channel)[0]) * self.VoltsPerCode
+
+    def sample_block(self, n, channel=None):
+        self.wait(n)
+        return self.read(n, channel)
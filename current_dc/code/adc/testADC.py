@@ -25,9 +25,41 @@
 #
 # ----------------------------------------------------------------------
 
+import math
+import time
+
+import numpy as np
+
+
 class ADC:
+    # constant 1V by default, or a mid-scale biased sine wave (test_waveform = "sine") delivered in
+    # real time for exercising the waveform pipeline
     def __init__(self, config):
-        pass
+        adc_conf = config.get('adc', {})
+        self.waveform = adc_conf.get('test_waveform', "constant")
+        self.amplitude = adc_conf.get('test_amplitude', 1.0)  # peak volts
+        self.frequency = adc_conf.get('test_frequency', 50)
+        self.sample_rate = adc_conf.get('test_sample_rate', 5000)
+        self.phase = 0.0
 
-    def sample(self):
+        self.ADCMax = 1000
+        self.ADCVoltage = 1.0
+        self.VoltsPerCode = self.ADCVoltage / self.ADCMax
+        if self.waveform == "sine":
+            self.ADCMax = pow(2, 12) - 1
+            self.ADCVoltage = 2 * self.amplitude + 0.5
+            self.VoltsPerCode = self.ADCVoltage / self.ADCMax
+
+    def sample(self, channel=None):
         return 1
+
+    def sample_block(self, n, channel=None):
+        if self.waveform != "sine":
+            return np.full(n, self.ADCMax, dtype=np.uint16)
+
+        step = 2 * math.pi * self.frequency / self.sample_rate
+        angles = self.phase + step * np.arange(n)
+        self.phase = (self.phase + step * n) % (2 * math.pi)
+        voltages = self.ADCVoltage / 2 + self.amplitude * np.sin(angles)
+        time.sleep(n / self.sample_rate)
+        return np.rint(voltages / self.VoltsPerCode).astype(np.uint16)
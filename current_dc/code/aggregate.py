@@ -0,0 +1,73 @@
+# ----------------------------------------------------------------------
+#
+#    Power Monitoring (Basic solution) -- This digital solution measures,
+#    reports and records both AC power and current consumed by an electrical 
+#    equipment, so that its energy consumption can be understood and 
+#    taken action upon. This version comes with one current transformer 
+#    clamp of 20A that is buckled up to the electric line the equipment 
+#    is connected to. The solution provides a Grafana dashboard that 
+#    displays current and power consumption, and an InfluxDB database 
+#    to store timestamp, current and power. 
+#
+#    Copyright (C) 2022  Shoestring and University of Cambridge
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3 of the License.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see https://www.gnu.org/licenses/.
+#
+# ----------------------------------------------------------------------
+
+import math
+
+# rolled-up readings are published below the base topic, e.g. power_monitoring/aggregate/15m/Machine_1
+aggregate_path = "aggregate/{{window}}/{{machine}}"
+measurement = "equipment_power_aggregate"
+
+
+class WindowAggregator:
+    # Running min / max / mean / count of each field per machine over wall-clock aligned windows, e.g. every whole
+    # minute, quarter hour and hour. A window is reported by the first reading that falls after it.
+    def __init__(self, windows, fields=("current", "power")):
+        self.windows = dict(windows)  # name -> seconds
+        self.fields = fields
+        self.open = {}  # (window name, machine) -> [window index, count, {field: [min, max, sum]}]
+
+    def add(self, machine, values, now):
+        # values are the reading's fields (floats, or strings from the json_string encoding), now is epoch seconds
+        values = {field: float(values[field]) for field in self.fields if field in values}
+        closed = []
+        for name, seconds in self.windows.items():
+            index = math.floor(now / seconds)
+            window = self.open.get((name, machine))
+            if window is not None and window[0] != index:
+                closed.append(self.summary(name, seconds, window))
+                window = None
+            if window is None:
+                window = self.open[(name, machine)] = [index, 0, {}]
+            window[1] += 1
+            for field, value in values.items():
+                stats = window[2].get(field)
+                if stats is None:
+                    window[2][field] = [value, value, value]
+                else:
+                    stats[0] = min(stats[0], value)
+                    stats[1] = max(stats[1], value)
+                    stats[2] += value
+        return closed
+
+    def summary(self, name, seconds, window):
+        index, count, fields = window
+        payload = {"window": name, "start": index * seconds, "count": count}
+        for field, (low, high, total) in fields.items():
+            payload[f"{field}_min"] = low
+            payload[f"{field}_max"] = high
+            payload[f"{field}_mean"] = total / count
+        return payload
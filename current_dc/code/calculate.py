@@ -28,24 +28,122 @@
 import logging
 import math
 
+import numpy as np
+
+import calibration
+
 logger = logging.getLogger("main.measure.conversion")
 
 
 class PowerMonitoringCalculation:
     one_over_sqrt_2 = 1 / math.sqrt(2)
 
-    def __init__(self, config):
+    def __init__(self, config, numeric=False):
+        # numeric - report native floats rather than strings
+        self.value_type = float if numeric else str
+        self.spectrum_bands = {}  # (block size, sample rate) -> (window, harmonic band bin indexes)
         calculation_conf = config['calculation']
         self.AmplifierGain = calculation_conf['amplifier_gain']
         self.CTRange = calculation_conf['current_range']
         self.phases = calculation_conf['phases']
         self.lineVoltage = calculation_conf['voltage']
 
+        # optional multi-point ADC volts -> amps calibration, replacing the nominal gain / range conversion
+        self.calibration = None
+        if calculation_conf.get('calibration'):
+            self.calibration = calibration.load_points(
+                calculation_conf.get('calibration_file', "./config/calibration.toml"), calculation_conf['calibration'])
+        self.lookup_tables = {}  # (lowest code, highest code, volts per code) -> amps per code
+
     def calculate(self, ADCAverageVoltage):
-        AmplifierVoltageIn = ADCAverageVoltage / self.AmplifierGain
+        return self.results(self.current(ADCAverageVoltage))
+
+    def current(self, ADCVoltage):
+        # clamp current (A RMS) for an ADC input voltage
+        if self.calibration is not None:
+            return float(calibration.interpolate(ADCVoltage, *self.calibration))
+        AmplifierVoltageIn = ADCVoltage / self.AmplifierGain
         CTClampCurrent = AmplifierVoltageIn * self.CTRange
         RMSCTClampCurrent = CTClampCurrent * self.one_over_sqrt_2
+        logger.debug(f"Vamp: {AmplifierVoltageIn}")
+        return RMSCTClampCurrent
+
+    def lookup_table(self, adc):
+        # current() for every code the ADC can return, built once per driver - the block conversion is then a
+        # single gather instead of per sample float arithmetic
+        low, high = calibration.code_range(adc)
+        key = (low, high, adc.VoltsPerCode)
+        table = self.lookup_tables.get(key)
+        if table is None:
+            if self.calibration is not None:
+                table = calibration.build_table(*self.calibration, low, high, adc.VoltsPerCode)
+            else:
+                scale = adc.VoltsPerCode / self.AmplifierGain * self.CTRange * self.one_over_sqrt_2
+                table = np.arange(low, high + 1) * scale
+            table = self.lookup_tables[key] = (table, low)
+        return table
+
+    def current_block(self, codes, adc):
+        # mean clamp current (A RMS) over a block of raw codes
+        table, low = self.lookup_table(adc)
+        indexes = codes if low == 0 else np.subtract(codes, low, dtype=np.int32)
+        return float(np.take(table, indexes, mode='clip').mean())
 
+    def calculate_rms(self, ADCRMSVoltage):
+        # true RMS input - no sine wave assumption needed
+        AmplifierVoltageIn = ADCRMSVoltage / self.AmplifierGain
+        RMSCTClampCurrent = AmplifierVoltageIn * self.CTRange
+        logger.debug(f"Vamp(rms): {AmplifierVoltageIn}")
+        return self.results(RMSCTClampCurrent)
+
+    def results(self, RMSCTClampCurrent):
         PowerValue = self.phases * RMSCTClampCurrent * self.lineVoltage
-        logger.debug(f"Vamp: {AmplifierVoltageIn} Irms: {RMSCTClampCurrent} P: {PowerValue}")
-        return {"current": str(RMSCTClampCurrent), "power": str(PowerValue)}
+        logger.debug(f"Irms: {RMSCTClampCurrent} P: {PowerValue}")
+        return {"current": self.value_type(RMSCTClampCurrent), "power": self.value_type(PowerValue)}
+
+    def convert_block(self, codes, volts_per_code):
+        # raw ADC codes -> instantaneous clamp current, in a single vectorised pass
+        scale = volts_per_code / self.AmplifierGain * self.CTRange
+        return np.multiply(codes, scale, dtype=np.float64)
+
+    def mean_square_block(self, codes, volts_per_code, remove_offset=True):
+        # mean of the squared ADC voltage over a block of raw codes
+        voltages = np.multiply(codes, volts_per_code, dtype=np.float64)
+        if remove_offset:
+            voltages -= voltages.mean()  # input is biased to mid-scale
+        return float(np.dot(voltages, voltages)) / len(voltages)
+
+    def harmonic_bands(self, n, sample_rate, fundamental, harmonics):
+        # Hann window and, per harmonic, the rfft bins of its main lobe (+-2 bins) - rows past Nyquist stay empty
+        key = (n, round(sample_rate), fundamental, harmonics)
+        bands = self.spectrum_bands.get(key)
+        if bands is None:
+            window = np.hanning(n)
+            centres = np.rint(np.arange(1, harmonics + 1) * fundamental * n / sample_rate).astype(np.int64)
+            bins = centres[:, None] + np.arange(-2, 3)
+            valid = (bins > 0) & (bins < n // 2)
+            # power of a component in V^2 (RMS squared) from its band, Parseval with the window's energy
+            scale = 2 / (n * float(np.dot(window, window)))
+            bands = self.spectrum_bands[key] = (window, np.where(valid, bins, 0), valid, scale)
+        return bands
+
+    def spectrum_block(self, codes, volts_per_code, sample_rate, fundamental=50, harmonics=15):
+        # power of the fundamental and each harmonic (V^2) and the peak |voltage| of a block, one FFT
+        window, bins, valid, scale = self.harmonic_bands(len(codes), sample_rate, fundamental, harmonics)
+        voltages = np.multiply(codes, volts_per_code, dtype=np.float64)
+        voltages -= voltages.mean()
+        spectrum = np.fft.rfft(voltages * window)
+        power = spectrum.real ** 2 + spectrum.imag ** 2
+        return np.where(valid, power[bins], 0).sum(axis=1) * scale, float(np.abs(voltages).max())
+
+    def power_quality(self, harmonic_power, peak_voltage, rms_voltage):
+        # THD (%), crest factor and RMS current of the fundamental and each harmonic from spectrum_block results
+        scale = self.CTRange / self.AmplifierGain
+        harmonic_rms = np.sqrt(harmonic_power) * scale
+        fundamental = harmonic_rms[0]
+        thd = float(np.sqrt(np.dot(harmonic_rms[1:], harmonic_rms[1:])) / fundamental * 100) if fundamental else 0.0
+        crest_factor = peak_voltage / rms_voltage if rms_voltage else 0.0
+        results = {"thd": self.value_type(thd), "crest_factor": self.value_type(crest_factor)}
+        for order, current in enumerate(harmonic_rms, 1):
+            results[f"harmonic_{order}"] = self.value_type(float(current))
+        return results
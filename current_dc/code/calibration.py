@@ -0,0 +1,67 @@
+# ----------------------------------------------------------------------
+#
+#    Power Monitoring (Basic solution) -- This digital solution measures,
+#    reports and records both AC power and current consumed by an electrical 
+#    equipment, so that its energy consumption can be understood and 
+#    taken action upon. This version comes with one current transformer 
+#    clamp of 20A that is buckled up to the electric line the equipment 
+#    is connected to. The solution provides a Grafana dashboard that 
+#    displays current and power consumption, and an InfluxDB database 
+#    to store timestamp, current and power. 
+#
+#    Copyright (C) 2022  Shoestring and University of Cambridge
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3 of the License.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see https://www.gnu.org/licenses/.
+#
+# ----------------------------------------------------------------------
+
+import logging
+
+import numpy as np
+import tomli
+
+logger = logging.getLogger("main.measure.calibration")
+
+
+def load_points(path, name):
+    # [name] table of a calibration file: points = [[ADC volts, clamp amps RMS], ...] measured against a reference
+    with open(path, "rb") as f:
+        tables = tomli.load(f)
+    if name not in tables:
+        raise ValueError(f"calibration {name} not found in {path}")
+    points = np.array(sorted(tables[name]['points']), dtype=np.float64)
+    if points.ndim != 2 or points.shape[1] != 2 or len(points) < 2:
+        raise ValueError(f"calibration {name} in {path} needs at least two [volts, amps] points")
+    if np.any(np.diff(points[:, 0]) <= 0):
+        raise ValueError(f"calibration {name} in {path} has repeated volts values")
+    logger.info(f"calibration {name}: {len(points)} points from {path}")
+    return points[:, 0], points[:, 1]
+
+
+def interpolate(volts, xs, ys):
+    # piecewise linear through the points, the end segments extended beyond them
+    amps = np.interp(volts, xs, ys)
+    low_slope = (ys[1] - ys[0]) / (xs[1] - xs[0])
+    high_slope = (ys[-1] - ys[-2]) / (xs[-1] - xs[-2])
+    amps = np.where(volts < xs[0], ys[0] + (volts - xs[0]) * low_slope, amps)
+    return np.where(volts > xs[-1], ys[-1] + (volts - xs[-1]) * high_slope, amps)
+
+
+def code_range(adc):
+    # lowest and highest raw code a driver's sample_block can return
+    return getattr(adc, 'CodeRange', (0, adc.ADCMax))
+
+
+def build_table(xs, ys, low, high, volts_per_code):
+    # amps for every raw code from low to high - 1024, 4096 or 65536 entries for 10, 12 and 16 bit ADCs
+    return interpolate(np.arange(low, high + 1) * volts_per_code, xs, ys)
@@ -0,0 +1,52 @@
+# ----------------------------------------------------------------------
+#
+#    Power Monitoring (Basic solution) -- This digital solution measures,
+#    reports and records both AC power and current consumed by an electrical 
+#    equipment, so that its energy consumption can be understood and 
+#    taken action upon. This version comes with one current transformer 
+#    clamp of 20A that is buckled up to the electric line the equipment 
+#    is connected to. The solution provides a Grafana dashboard that 
+#    displays current and power consumption, and an InfluxDB database 
+#    to store timestamp, current and power. 
+#
+#    Copyright (C) 2022  Shoestring and University of Cambridge
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3 of the License.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see https://www.gnu.org/licenses/.
+#
+# ----------------------------------------------------------------------
+
+
+class ReportByException:
+    # Decides whether a reading is worth publishing: a field has moved from the last published value by more than
+    # its deadband, or nothing has been published for heartbeat seconds. The deadband of a field is the larger of
+    # its absolute setting and relative * |last value|, so small relative changes near zero stay suppressed.
+    def __init__(self, absolute, relative=0.0, heartbeat=300):
+        self.absolute = dict(absolute)  # field -> deadband in the field's units
+        self.relative = relative
+        self.heartbeat = heartbeat
+        self.published = {}  # machine -> (monotonic seconds, {field: value})
+
+    def should_publish(self, machine, payload, now):
+        values = {field: float(payload[field]) for field in self.absolute if field in payload}
+        last = self.published.get(machine)
+        if last is None or now - last[0] >= self.heartbeat or self.exceeded(values, last[1]):
+            self.published[machine] = (now, values)
+            return True
+        return False
+
+    def exceeded(self, values, last_values):
+        for field, value in values.items():
+            last = last_values.get(field)
+            if last is None or abs(value - last) > max(self.absolute[field], self.relative * abs(last)):
+                return True
+        return False
@@ -0,0 +1,112 @@
+# ----------------------------------------------------------------------
+#
+#    Power Monitoring (Basic solution) -- This digital solution measures,
+#    reports and records both AC power and current consumed by an electrical 
+#    equipment, so that its energy consumption can be understood and 
+#    taken action upon. This version comes with one current transformer 
+#    clamp of 20A that is buckled up to the electric line the equipment 
+#    is connected to. The solution provides a Grafana dashboard that 
+#    displays current and power consumption, and an InfluxDB database 
+#    to store timestamp, current and power. 
+#
+#    Copyright (C) 2022  Shoestring and University of Cambridge
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3 of the License.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see https://www.gnu.org/licenses/.
+#
+# ----------------------------------------------------------------------
+
+import datetime
+import json
+import math
+
+epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+# MQTT payload encodings for readings, selected by mqtt.encoding:
+#   json_string - JSON with current/power as strings (original format)
+#   json        - JSON with native numbers
+#   msgpack     - MessagePack map with native numbers
+#   line        - InfluxDB line protocol, ready to ingest
+encodings = ["json_string", "json", "msgpack", "line"]
+
+
+def numeric(encoding):
+    # every encoding apart from the original one carries numbers rather than strings
+    return encoding != "json_string"
+
+
+def get_encoder(encoding, measurement="equipment_power_usage"):
+    if encoding in ("json_string", "json"):
+        return json.dumps
+    if encoding == "msgpack":
+        import msgpack  # only needed for this encoding
+        return msgpack.packb
+    if encoding == "line":
+        return lambda payload: encode_line(payload, measurement)
+    raise ValueError(f"unknown encoding {encoding}, expected one of {encodings}")
+
+
+def get_batch_encoder(encoding, measurement="equipment_power_usage"):
+    # several readings in one message - an array for JSON / MessagePack, one line per reading for line protocol
+    if encoding == "line":
+        return lambda payloads: "\n".join(encode_line(payload, measurement) for payload in payloads)
+    return get_encoder(encoding, measurement)
+
+
+def flatten(payload, prefix=""):
+    # nested dicts (e.g. metrics snapshots) to one level, keys joined with "_" as telegraf's json_v2 does
+    flat = {}
+    for key, value in payload.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}_"))
+        else:
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def escape_key(key):
+    return key.replace(",", r"\,").replace("=", r"\=").replace(" ", r"\ ")
+
+
+def epoch_ns(timestamp):
+    if isinstance(timestamp, int):
+        return timestamp
+    elapsed = datetime.datetime.fromisoformat(timestamp) - epoch
+    return (elapsed.days * 86400 + elapsed.seconds) * 1000000000 + elapsed.microseconds * 1000
+
+
+def escape_string(value):
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def encode_line(payload, measurement, string_fields=()):
+    # strings become tags (apart from the keys in string_fields), numbers become fields - e.g.
+    # equipment_power_usage,machine=Machine_1 current=7.07,power=5091.1 1700000000000000000
+    tags = []
+    fields = []
+    for key, value in payload.items():
+        if key == "timestamp":
+            continue
+        if isinstance(value, str) and key in string_fields:
+            fields.append(f"{escape_key(key)}={escape_string(value)}")
+        elif isinstance(value, str):
+            tags.append(f"{escape_key(key)}={escape_key(value)}")
+        elif isinstance(value, bool):
+            fields.append(f"{escape_key(key)}={'true' if value else 'false'}")
+        elif isinstance(value, int):
+            fields.append(f"{escape_key(key)}={value}i")
+        elif isinstance(value, float) and math.isfinite(value):
+            fields.append(f"{escape_key(key)}={value!r}")
+    line = ",".join([escape_key(measurement)] + sorted(tags)) + " " + ",".join(fields)
+    if "timestamp" in payload:
+        line += f" {epoch_ns(payload['timestamp'])}"
+    return line
@@ -0,0 +1,102 @@
+# ----------------------------------------------------------------------
+#
+#    Power Monitoring (Basic solution) -- This digital solution measures,
+#    reports and records both AC power and current consumed by an electrical 
+#    equipment, so that its energy consumption can be understood and 
+#    taken action upon. This version comes with one current transformer 
+#    clamp of 20A that is buckled up to the electric line the equipment 
+#    is connected to. The solution provides a Grafana dashboard that 
+#    displays current and power consumption, and an InfluxDB database 
+#    to store timestamp, current and power. 
+#
+#    Copyright (C) 2022  Shoestring and University of Cambridge
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3 of the License.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see https://www.gnu.org/licenses/.
+#
+# ----------------------------------------------------------------------
+
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger("main.energy")
+
+
+class EnergyAccumulator:
+    # Monotonically increasing kWh counter per machine - power integrated over the actual time between readings
+    # (trapezoidal). Totals are checkpointed to a JSON file with a write to a temporary file and a rename, so a
+    # restart carries on from the last checkpoint and never sees half a file. The checkpoint is kept ahead of every
+    # total returned for publishing - it reserves checkpoint_interval worth of energy at the current power and is
+    # rewritten once a total reaches it - so a restored total is never below one already published. close() writes
+    # the exact totals on shutdown.
+    def __init__(self, path, checkpoint_interval=60, max_gap=60):
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+        self.max_gap = max_gap  # seconds - longer gaps (stalls, restarts) are not integrated across
+        self.totals = {}  # machine -> kWh
+        self.stored = {}  # machine -> kWh in the checkpoint file
+        self.last = {}  # machine -> (monotonic seconds, watts)
+        self.lock = threading.Lock()  # close() may be called from another thread (threads deployment)
+        if path:
+            self.restore()
+
+    def restore(self):
+        try:
+            with open(self.path) as f:
+                self.totals = {machine: float(kwh) for machine, kwh in json.load(f).items()}
+            self.stored = dict(self.totals)
+            logger.info(f"energy totals restored from {self.path}: {self.totals}")
+        except FileNotFoundError:
+            pass
+        except (ValueError, AttributeError) as e:
+            logger.error(f"ignoring unreadable energy checkpoint {self.path} ({e})")
+
+    def add(self, machine, watts, now):
+        # now is time.monotonic(), returns the machine's running total in kWh
+        with self.lock:
+            total = self.totals.get(machine, 0.0)
+            last = self.last.get(machine)
+            if last is not None and 0 < now - last[0] <= self.max_gap:
+                total += (watts + last[1]) / 2 * (now - last[0]) / 3600000
+                self.totals[machine] = total
+            else:
+                self.totals.setdefault(machine, total)
+            self.last[machine] = (now, watts)
+
+            if self.path and total > self.stored.get(machine, -1.0):
+                # about to publish a total the checkpoint doesn't cover - move the checkpoint ahead first
+                self.checkpoint({m: kwh + max(self.last.get(m, (0, 0))[1], 0) * self.checkpoint_interval / 3600000
+                                 for m, kwh in self.totals.items()})
+            return total
+
+    def close(self):
+        with self.lock:
+            if self.path and self.totals:
+                self.checkpoint(dict(self.totals))
+                logger.info(f"energy totals checkpointed to {self.path}: {self.totals}")
+
+    def checkpoint(self, totals):
+        temporary = self.path + ".tmp"
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(temporary, "w") as f:
+                json.dump(totals, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, self.path)
+            self.stored = totals
+        except OSError as e:
+            logger.error(f"unable to checkpoint energy totals to {self.path} ({e})")
@@ -0,0 +1,179 @@
+# ----------------------------------------------------------------------
+#
+#    Power Monitoring (Basic solution) -- This digital solution measures,
+#    reports and records both AC power and current consumed by an electrical 
+#    equipment, so that its energy consumption can be understood and 
+#    taken action upon. This version comes with one current transformer 
+#    clamp of 20A that is buckled up to the electric line the equipment 
+#    is connected to. The solution provides a Grafana dashboard that 
+#    displays current and power consumption, and an InfluxDB database 
+#    to store timestamp, current and power. 
+#
+#    Copyright (C) 2022  Shoestring and University of Cambridge
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3 of the License.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see https://www.gnu.org/licenses/.
+#
+# ----------------------------------------------------------------------
+
+import collections
+import concurrent.futures
+import datetime
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger("main.measure.events")
+
+# event summaries are published below the base topic, e.g. power_monitoring/events/Machine_1
+event_path = "events/{{machine}}"
+measurement = "equipment_power_event"
+
+
+class EventRecorder:
+    # Keeps the last pre_trigger seconds of raw waveform blocks of one channel. When the per mains cycle RMS current
+    # goes over threshold (A) or changes faster than di_dt (A/s) the blocks around it - pre_trigger seconds before,
+    # post_trigger seconds after - are saved to a compressed .npz file and a summary is returned for publishing.
+    # Works on the blocks the capture thread has already taken, so the readings are not disturbed.
+    def __init__(self, machine, directory, threshold=0, di_dt=0, pre_trigger=0.5, post_trigger=2, holdoff=10,
+                 fundamental=50, writer=None):
+        self.machine = machine
+        self.directory = directory
+        self.threshold = threshold
+        self.di_dt = di_dt
+        self.pre_trigger = pre_trigger
+        self.post_trigger = post_trigger
+        self.holdoff = holdoff
+        self.fundamental = fundamental
+        self.writer = writer  # executor the files are written on, off the measure loop
+
+        self.blocks = collections.deque()  # (start epoch ns, codes) of the last pre_trigger seconds
+        self.buffered = 0  # samples held in blocks
+        self.last_cycle = None  # RMS of the last cycle of the previous block
+        self.event = None  # the event being recorded until post_trigger seconds have been captured
+        self.quiet_until = 0  # epoch ns - no new event before then
+
+    def add(self, start_ns, codes, volts_per_code, sample_rate, calculation):
+        # returns the event summary once an event's post trigger samples are complete, None otherwise
+        if sample_rate <= 0:
+            return None
+        self.blocks.append((start_ns, codes))
+        self.buffered += len(codes)
+
+        if self.event is not None:
+            self.event['post_samples'] += len(codes)
+            self.event['blocks'].append((start_ns, codes))
+            self.update(self.event, self.cycle_rms(codes, volts_per_code, sample_rate, calculation), sample_rate)
+            if self.event['post_samples'] < self.post_trigger * sample_rate:
+                return None
+            return self.finish(volts_per_code, sample_rate)
+
+        cycles = self.cycle_rms(codes, volts_per_code, sample_rate, calculation)
+        reason, index, rate = self.check(cycles, sample_rate)
+        if reason is not None and start_ns >= self.quiet_until:
+            samples_per_cycle = sample_rate / self.fundamental
+            self.event = {
+                "reason": reason,
+                "trigger_ns": start_ns + round((index * samples_per_cycle) / sample_rate * 1e9),
+                "current_before": float(self.last_cycle if self.last_cycle is not None else cycles[0]),
+                "current_max": 0.0,
+                "di_dt_max": rate,
+                "post_samples": len(codes) - int(index * samples_per_cycle),
+                "blocks": list(self.blocks),  # the pre trigger history including this block
+            }
+            self.update(self.event, cycles, sample_rate)
+            if self.event['post_samples'] >= self.post_trigger * sample_rate:
+                return self.finish(volts_per_code, sample_rate)
+        if len(cycles):
+            self.last_cycle = cycles[-1]
+
+        # trim the history to pre_trigger seconds, always keeping the latest block
+        while len(self.blocks) > 1 and self.buffered - len(self.blocks[0][1]) >= self.pre_trigger * sample_rate:
+            self.buffered -= len(self.blocks.popleft()[1])
+        return None
+
+    def cycle_rms(self, codes, volts_per_code, sample_rate, calculation):
+        # RMS current of each whole mains cycle in the block - the envelope the trigger looks at
+        samples_per_cycle = max(1, round(sample_rate / self.fundamental))
+        cycles = len(codes) // samples_per_cycle
+        if cycles == 0:
+            return np.empty(0)
+        current = calculation.convert_block(codes[:cycles * samples_per_cycle], volts_per_code)
+        current -= current.mean()
+        return np.sqrt(np.mean(np.square(current.reshape(cycles, samples_per_cycle)), axis=1))
+
+    def check(self, cycles, sample_rate):
+        # first cycle over the threshold, or changing from the one before faster than di_dt
+        if len(cycles) == 0:
+            return None, 0, 0.0
+        previous = np.concatenate(([cycles[0] if self.last_cycle is None else self.last_cycle], cycles[:-1]))
+        rates = np.abs(cycles - previous) * self.fundamental  # A/s, one cycle apart
+        if self.threshold > 0:
+            # crossing up into the threshold rather than staying above it
+            crossing = np.flatnonzero((cycles > self.threshold) & (previous <= self.threshold))
+            if len(crossing):
+                return "threshold", int(crossing[0]), float(rates[crossing[0]])
+        if self.di_dt > 0:
+            fast = np.flatnonzero(rates > self.di_dt)
+            if len(fast):
+                return "di_dt", int(fast[0]), float(rates[fast[0]])
+        return None, 0, 0.0
+
+    def update(self, event, cycles, sample_rate):
+        if len(cycles):
+            event['current_max'] = max(event['current_max'], float(cycles.max()))
+            if len(cycles) > 1:
+                event['di_dt_max'] = max(event['di_dt_max'], float(np.abs(np.diff(cycles)).max()) * self.fundamental)
+
+    def finish(self, volts_per_code, sample_rate):
+        event = self.event
+        self.event = None
+        self.quiet_until = event['trigger_ns'] + round((self.post_trigger + self.holdoff) * 1e9)
+        blocks = event.pop('blocks')
+        trigger_ns = event.pop('trigger_ns')
+        event.pop('post_samples')
+
+        name = f"{self.machine}_{datetime.datetime.fromtimestamp(trigger_ns / 1e9):%Y%m%d_%H%M%S_%f}.npz"
+        path = os.path.join(self.directory, name)
+        arrays = {
+            "codes": np.concatenate([codes for _start, codes in blocks]),
+            "block_starts": np.array([start for start, _codes in blocks], dtype=np.int64),  # epoch ns
+            "block_lengths": np.array([len(codes) for _start, codes in blocks], dtype=np.int64),
+            "trigger_ns": np.int64(trigger_ns),
+            "sample_rate": np.float64(sample_rate),
+            "volts_per_code": np.float64(volts_per_code),
+        }
+        if self.writer is None:
+            save(path, arrays)
+        else:
+            self.writer.submit(save, path, arrays)
+
+        duration = sum(len(codes) for _start, codes in blocks) / sample_rate
+        return {**event, "trigger_ns": trigger_ns, "duration": duration, "file": name}
+
+
+def save(path, arrays):
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, path)
+        logger.info(f"event waveform saved to {path}")
+    except OSError as e:
+        logger.error(f"unable to save event waveform {path}: {e}")
+
+
+def create_writer():
+    # one background thread so that compressing and writing a capture never holds up sampling
+    return concurrent.futures.ThreadPoolExecutor(1, "events")
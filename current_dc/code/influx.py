@@ -0,0 +1,235 @@
+# ----------------------------------------------------------------------
+#
+#    Power Monitoring (Basic solution) -- This digital solution measures,
+#    reports and records both AC power and current consumed by an electrical 
+#    equipment, so that its energy consumption can be understood and 
+#    taken action upon. This version comes with one current transformer 
+#    clamp of 20A that is buckled up to the electric line the equipment 
+#    is connected to. The solution provides a Grafana dashboard that 
+#    displays current and power consumption, and an InfluxDB database 
+#    to store timestamp, current and power. 
+#
+#    Copyright (C) 2022  Shoestring and University of Cambridge
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3 of the License.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see https://www.gnu.org/licenses/.
+#
+# ----------------------------------------------------------------------
+
+import datetime
+import gzip
+import http.client
+import json
+import logging
+import multiprocessing
+import time
+import zmq
+from urllib.parse import urlencode, urlsplit
+
+import encoding
+import events
+import metrics
+
+context = zmq.Context.instance()  # shared by every building block in the process, as inproc:// requires
+logger = logging.getLogger("main.influx")
+
+# measurement names the telegraf config gives the diagnostics messages, keyed by the last path segment
+diagnostics_measurements = {
+    "scheduler": "sampling_scheduler",
+    "measure_metrics": "data_collector_metrics",
+    "influx_metrics": "data_collector_metrics",
+}
+
+# string values written as fields rather than tags, as telegraf's json_v2 inputs do with keys not listed as tags -
+# e.g. every event has its own file name, which as a tag would start a new series per event
+string_fields = {
+    events.measurement: ("file",),
+}
+
+
+class InfluxWriterBuildingBlock(multiprocessing.Process):
+    # Takes the wrapper's place and writes readings straight to the InfluxDB v2 HTTP API as gzip-compressed line
+    # protocol, skipping the MQTT broker and telegraf. Points are buffered and written every flush_interval seconds
+    # or as soon as batch_size are waiting, like telegraf's agent settings.
+    def __init__(self, config, zmq_conf):
+        super().__init__()
+
+        influx_conf = config['influx']
+        url = urlsplit(influx_conf.get('url', "http://timeseries-db.docker.local:8086"))
+        self.https = url.scheme == "https"
+        self.host = url.netloc
+        self.write_path = url.path.rstrip("/") + "/api/v2/write?" + urlencode(
+            {"org": influx_conf.get('org', ""), "bucket": influx_conf.get('bucket', ""), "precision": "ns"})
+        self.headers = {"Authorization": f"Token {influx_conf.get('token', '')}",
+                        "Content-Type": "text/plain; charset=utf-8"}
+        self.gzip = influx_conf.get('gzip', True)
+        if self.gzip:
+            self.headers["Content-Encoding"] = "gzip"
+        self.timeout = influx_conf.get('timeout', 5)
+
+        self.batch_size = influx_conf.get('batch_size', 1000)
+        self.flush_interval = influx_conf.get('flush_interval', 5)
+        self.buffer_limit = influx_conf.get('buffer_limit', 10000)
+        self.initial = influx_conf.get('retry', {}).get('initial', 1)
+        self.backoff = influx_conf.get('retry', {}).get('backoff', 2)
+        self.limit = influx_conf.get('retry', {}).get('limit', 60)
+
+        self.measurement = config['mqtt'].get('measurement', "equipment_power_usage")
+        self.constants = config['constants']
+        self.timestamp_format = config['sampling'].get('timestamp_format', "iso")
+
+        # declarations
+        self.zmq_conf = zmq_conf
+        self.zmq_in = None
+        self.connection = None
+        self.buffer = []
+        self.retry_timeout = self.initial
+        self.retry_at = None
+
+        metrics_conf = config.get('metrics', {})
+        self.metrics = metrics.Metrics("influx")
+        self.metrics_interval = metrics_conf.get('interval', 0)
+        self.metrics_port = metrics_conf.get('wrapper_http_port', 0)
+
+    def do_connect(self):
+        self.zmq_in = context.socket(self.zmq_conf['type'])
+        self.zmq_in.setsockopt(zmq.RCVHWM, self.zmq_conf.get('hwm', 1000))
+        if self.zmq_conf["bind"]:
+            self.zmq_in.bind(self.zmq_conf["address"])
+        else:
+            self.zmq_in.connect(self.zmq_conf["address"])
+
+    def run(self):
+        self.do_connect()
+        if self.metrics_port:
+            self.metrics.serve(self.metrics_port)
+        logger.info(f"writing to {'https' if self.https else 'http'}://{self.host}")
+
+        now = time.monotonic()
+        next_flush = now + self.flush_interval
+        next_metrics = now + self.metrics_interval
+        while True:
+            wake = next_flush if self.retry_at is None else max(next_flush, self.retry_at)
+            if 0 < self.metrics_interval:
+                wake = min(wake, next_metrics)
+            if self.zmq_in.poll(max(0.0, wake - time.monotonic()) * 1000, zmq.POLLIN):
+                while True:
+                    try:
+                        msg = self.zmq_in.recv(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    self.handle_message(json.loads(msg))
+                if len(self.buffer) >= self.batch_size:
+                    self.flush()
+
+            now = time.monotonic()
+            if 0 < self.metrics_interval and next_metrics <= now:
+                next_metrics += self.metrics_interval
+                self.write_metrics()
+            if next_flush <= now:
+                self.flush()
+                next_flush = max(next_flush + self.flush_interval, now)
+
+    def handle_message(self, msg_json):
+        self.metrics.count("messages_received")
+        if 'block' in msg_json:
+            # raw waveform blocks only go out over MQTT
+            self.metrics.count("waveform_blocks_skipped")
+            return
+        if 'measurement' in msg_json:
+            measurement = msg_json['measurement']
+        elif msg_json.get('format') == "json":
+            name = msg_json['path'].rstrip("/").rsplit("/", 1)[-1]
+            measurement = diagnostics_measurements.get(name, name)
+        else:
+            measurement = self.measurement
+        msg_payloads = msg_json['payloads'] if 'payloads' in msg_json else [msg_json['payload']]
+        for msg_payload in msg_payloads:
+            self.add_point(self.encode({**self.constants, **msg_payload}, measurement))
+
+    def encode(self, payload, measurement):
+        # telegraf stores every JSON number as a float - integers are written the same way so that both paths
+        # can share a bucket without field type conflicts
+        payload = {key: float(value) if type(value) is int and key != "timestamp" else value
+                   for key, value in encoding.flatten(payload).items()}
+        return encoding.encode_line(payload, measurement, string_fields.get(measurement, ()))
+
+    def add_point(self, line):
+        self.buffer.append(line)
+        if len(self.buffer) > self.buffer_limit:
+            # like telegraf's metric_buffer_limit - the oldest points go first
+            excess = len(self.buffer) - self.buffer_limit
+            del self.buffer[:excess]
+            self.metrics.count("points_dropped", excess)
+
+    def write_metrics(self):
+        if self.timestamp_format == "epoch_ns":
+            timestamp = time.time_ns()
+        else:
+            timestamp = datetime.datetime.now().astimezone().isoformat()
+        snapshot = {**self.metrics.snapshot(), **self.constants, "timestamp": timestamp}
+        self.add_point(self.encode(snapshot, diagnostics_measurements["influx_metrics"]))
+
+    def flush(self):
+        # write batch_size points at a time until the buffer is empty or a write fails
+        while self.buffer and (self.retry_at is None or self.retry_at <= time.monotonic()):
+            batch = self.buffer[:self.batch_size]
+            if not self.write(batch):
+                break
+            del self.buffer[:len(batch)]
+        self.metrics.gauge("buffered_points", len(self.buffer))
+
+    def write(self, batch):
+        body = "\n".join(batch).encode()
+        if self.gzip:
+            body = gzip.compress(body, compresslevel=6)
+        write_start = time.perf_counter()
+        try:
+            if self.connection is None:
+                # kept open between writes - one TCP (and TLS) handshake instead of one per batch
+                connection_type = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+                self.connection = connection_type(self.host, timeout=self.timeout)
+            self.connection.request("POST", self.write_path, body, self.headers)
+            response = self.connection.getresponse()
+            detail = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            logger.error(f"write to InfluxDB failed ({e}), retrying in {self.retry_timeout} seconds")
+            self.connection.close()
+            self.connection = None
+            self.schedule_retry()
+            return False
+        self.metrics.observe("write", time.perf_counter() - write_start)
+
+        if response.status < 300:
+            self.metrics.count("points_written", len(batch))
+            self.metrics.count("bytes_written", len(body))
+            self.retry_timeout = self.initial
+            self.retry_at = None
+            return True
+        if response.status == 429 or response.status >= 500:
+            # InfluxDB is overloaded or unavailable - keep the points and back off
+            retry_after = response.getheader("Retry-After")
+            logger.error(f"InfluxDB returned {response.status}, retrying in {retry_after or self.retry_timeout} seconds")
+            self.schedule_retry(float(retry_after) if retry_after and retry_after.isdigit() else None)
+            return False
+        # anything else (bad request, unauthorised, missing bucket) won't succeed on a retry
+        logger.error(f"InfluxDB rejected {len(batch)} points with {response.status}: {detail[:200]}")
+        self.metrics.count("points_rejected", len(batch))
+        return True
+
+    def schedule_retry(self, delay=None):
+        self.metrics.count("write_errors")
+        self.retry_at = time.monotonic() + (delay if delay is not None else self.retry_timeout)
+        if self.retry_timeout < self.limit:
+            self.retry_timeout = self.retry_timeout * self.backoff
+        else:
+            self.retry_timeout = self.limit
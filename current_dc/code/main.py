@@ -33,11 +33,16 @@
 
 # packages
 import tomli
+import signal
+import sys
 import time
 import logging
+import threading
 import zmq
 # local
+import influx
 import measure
+import ringbuffer
 import wrapper
 
 logger = logging.getLogger("main")
@@ -55,22 +60,59 @@ def config_valid(config):
     return True
 
 
-def create_building_blocks(config):
-    bbs = {}
+def create_waveform_ring(config):
+    # raw waveform blocks bypass ZMQ through shared memory, created here so that both processes inherit it
+    waveform_conf = config.get('waveform', {})
+    if waveform_conf.get('transport', "none") != "shm":
+        return None
+    return ringbuffer.SharedRingBuffer(waveform_conf.get('ring_slots', 16), waveform_conf.get('block_size', 2000))
+
 
-    measure_out = {"type": zmq.PUSH, "address": "tcp://127.0.0.1:4000", "bind": True}
-    wrapper_in = {"type": zmq.PULL, "address": "tcp://127.0.0.1:4000", "bind": False}
+def create_building_blocks(config, ring=None):
+    bbs = {}
 
-    bbs["measure"] = measure.CurrentMeasureBuildingBlock(config, measure_out)
-    bbs["wrapper"] = wrapper.MQTTServiceWrapper(config, wrapper_in)
+    # threads in one process talk over inproc:// - no loopback TCP, no second interpreter
+    if deployment_mode(config) == "threads":
+        address = "inproc://measure"
+    else:
+        address = "tcp://127.0.0.1:4000"
+    hwm = config.get('zmq', {}).get('hwm', 1000)
+    measure_out = {"type": zmq.PUSH, "address": address, "bind": True, "hwm": hwm}
+    wrapper_in = {"type": zmq.PULL, "address": address, "bind": False, "hwm": hwm}
+
+    bbs["measure"] = measure.CurrentMeasureBuildingBlock(config, measure_out, ring)
+    if config.get('influx', {}).get('enabled', False):
+        # straight to InfluxDB instead of through the MQTT broker and telegraf
+        bbs["wrapper"] = influx.InfluxWriterBuildingBlock(config, wrapper_in)
+    else:
+        bbs["wrapper"] = wrapper.MQTTServiceWrapper(config, wrapper_in, ring)
 
     logger.debug(f"bbs {bbs}")
     return bbs
 
 
-def start_building_blocks(bbs):
+def deployment_mode(config):
+    return config.get('deployment', {}).get('mode', "processes")
+
+
+def start_building_blocks(bbs, mode="processes"):
+    for key in bbs:
+        if mode == "threads":
+            # the building block's run() on a thread of this process rather than in a child process
+            threading.Thread(target=bbs[key].run, name=key, daemon=True).start()
+        else:
+            p = bbs[key].start()
+
+
+def stop_building_blocks(bbs, mode="processes"):
+    # lets measure checkpoint its energy totals before the container goes away
     for key in bbs:
-        p = bbs[key].start()
+        if mode == "threads":
+            if hasattr(bbs[key], "shutdown"):
+                bbs[key].shutdown()
+        elif bbs[key].is_alive():
+            bbs[key].terminate()
+            bbs[key].join(5)
 
 
 def monitor_building_blocks(bbs):
@@ -86,8 +128,17 @@ if __name__ == "__main__":
     conf = get_config()
     # todo set logging level from config file
     if config_valid(conf):
-        bbs = create_building_blocks(conf)
-        start_building_blocks(bbs)
-        monitor_building_blocks(bbs)
+        ring = create_waveform_ring(conf)
+        signal.signal(signal.SIGTERM, lambda _signum, _frame: sys.exit(0))  # docker stop
+        bbs = {}
+        try:
+            bbs = create_building_blocks(conf, ring)
+            start_building_blocks(bbs, deployment_mode(conf))
+            monitor_building_blocks(bbs)
+        finally:
+            stop_building_blocks(bbs, deployment_mode(conf))
+            if ring is not None:
+                ring.close()
+                ring.unlink()
     else:
         raise Exception("bad config")
@@ -31,22 +31,40 @@
 # extract variables
 # output variables
 
+import collections
+import concurrent.futures
 import datetime
 import logging
+import math
 import multiprocessing
+import queue
+import signal
+import sys
+import threading
 import time
 
 import importlib
 import zmq
 
+import aggregate
 import calculate as calc
+import deadband
+import encoding
+import energy
+import events
+import metrics
+import scheduler
+import waveform
 
 logger = logging.getLogger("main.measure")
-context = zmq.Context()
+context = zmq.Context.instance()  # shared by every building block in the process, as inproc:// requires
+
+# raw waveform blocks (shared memory transport only), e.g. power_monitoring/waveform/Machine_1
+waveform_path = "waveform/{{machine}}"
 
 
 class CurrentMeasureBuildingBlock(multiprocessing.Process):
-    def __init__(self, config, zmq_conf):
+    def __init__(self, config, zmq_conf, ring=None):
         super().__init__()
 
         self.config = config
@@ -55,13 +73,78 @@ class CurrentMeasureBuildingBlock(multiprocessing.Process):
         # declarations
         self.zmq_conf = zmq_conf
         self.zmq_out = None
+        self.ring = ring
+        self.waveform_dropped = 0
+        self.tz = None
+        self.next_check = 0
+        self.metrics = metrics.Metrics("measure")
+        self.next_metrics = 0
 
         self.collection_interval = config['sampling']['sample_interval']
         self.sample_count = config['sampling']['sample_count']
+        self.block_size = config['sampling'].get('block_size', 1)
+        self.mode = config['sampling'].get('mode', "average")
+        if self.mode == "rms":
+            # calibration points are average-mode ADC volts, rms mode (readings, power quality, events) converts
+            # instantaneous samples with the nominal gain / range
+            calculations = [config['calculation']] + [c.get('calculation', {}) for c in config.get('channels', [])]
+            if any(calculation.get('calibration') for calculation in calculations):
+                raise ValueError("calculation.calibration is only supported with sampling.mode = \"average\"")
+        self.stats_interval = config['sampling'].get('stats_interval', 0)
+        self.timestamp_format = config['sampling'].get('timestamp_format', "iso")
         self.adc_module = config['adc']['adc_module']
+        # the InfluxDB writer needs numbers for fields whatever the MQTT encoding
+        self.numeric = (encoding.numeric(config['mqtt'].get('encoding', "json_string"))
+                        or config.get('influx', {}).get('enabled', False))
+
+        waveform_conf = config.get('waveform', {})
+        self.waveform_block_size = waveform_conf.get('block_size', 2000)
+        self.waveform_queue_length = waveform_conf.get('queue_length', 8)
+        self.remove_offset = waveform_conf.get('remove_offset', True)
+
+        # THD, crest factor and harmonic spectrum from the waveform blocks (rms mode)
+        quality_conf = config.get('power_quality', {})
+        self.power_quality = quality_conf.get('enabled', False)
+        self.fundamental = quality_conf.get('fundamental', 50)
+        self.harmonics = quality_conf.get('harmonics', 15)
+        self.quality_sample_rate = quality_conf.get('sample_rate', 0)
+
+        # triggered capture of inrush / fault waveforms (rms mode)
+        self.events_conf = config.get('events', {})
+        if self.events_conf.get('enabled', False) and self.mode != "rms":
+            logger.warning("events need sampling.mode = \"rms\", triggered capture disabled")
+
+        metrics_conf = config.get('metrics', {})
+        self.metrics_interval = metrics_conf.get('interval', 0)
+        self.metrics_port = metrics_conf.get('measure_http_port', 0)
+
+        # what to do when the wrapper can't keep up and the ZMQ queue is full
+        link_conf = config.get('zmq', {})
+        self.overflow = link_conf.get('overflow', "drop_oldest")
+        self.backlog_limit = link_conf.get('backlog', 1000)
+        self.backlog = collections.OrderedDict()  # messages ZMQ would not take yet, oldest first
+        self.backlog_key = 0
+
+        energy_conf = config.get('energy', {})
+        self.energy = None
+        if energy_conf.get('enabled', False):
+            self.energy = energy.EnergyAccumulator(energy_conf.get('checkpoint_path', ""),
+                                                   energy_conf.get('checkpoint_interval', 60),
+                                                   energy_conf.get('max_gap', 60))
+
+        reporting_conf = config.get('reporting', {})
+        self.exceptions = None
+        if reporting_conf.get('mode', "interval") == "exception":
+            self.exceptions = deadband.ReportByException(reporting_conf.get('deadband', {"current": 0.1, "power": 25}),
+                                                         reporting_conf.get('deadband_relative', 0.0),
+                                                         reporting_conf.get('heartbeat', 300))
+
+        windows = config.get('aggregation', {}).get('windows', {})
+        self.aggregator = aggregate.WindowAggregator(windows) if windows else None
 
     def do_connect(self):
         self.zmq_out = context.socket(self.zmq_conf['type'])
+        self.zmq_out.setsockopt(zmq.SNDHWM, self.zmq_conf.get('hwm', 1000))
         if self.zmq_conf["bind"]:
             self.zmq_out.bind(self.zmq_conf["address"])
         else:
@@ -70,79 +153,398 @@ class CurrentMeasureBuildingBlock(multiprocessing.Process):
     def run(self):
         logger.info("started")
         self.do_connect()
+        if self.metrics_port:
+            self.metrics.serve(self.metrics_port)
+        self.next_metrics = time.monotonic() + self.metrics_interval
 
-        # timezone determination
-        __dt = -1 * (time.timezone if (time.localtime().tm_isdst == 0) else time.altzone)
-        tz = datetime.timezone(datetime.timedelta(seconds=__dt))
-        #
-        today = datetime.datetime.now().date()
-        next_check = (datetime.datetime(today.year, today.month, today.day) + datetime.timedelta(days=1)).timestamp()
+        # one ADC, or one per [[adcs]] board
+        adcs_conf = self.config.get('adcs') or [{"name": ""}]
+        adcs = {}
+        for adc_conf in adcs_conf:
+            # get correct ADC module
+            module_name = adc_conf.get('adc_module', self.adc_module)
+            try:
+                adc_module = importlib.import_module(f"adc.{module_name}")
+                logger.debug(f"Imported {module_name}")
+            except ModuleNotFoundError as e:
+                logger.error(f"Unable to import module {module_name}. Stopping!!")
+                return
+            # each board's bus / address settings are layered over [adc]
+            adcs[adc_conf['name']] = adc_module.ADC({**self.config, "adc": {**self.config['adc'], **adc_conf}})
 
-        run = True
-        period = self.collection_interval
+        channels = self.build_channels(adcs)
+        # channel indexes grouped by board - boards are read in parallel, the channels of a board in turn
+        boards = {}
+        for index, channel in enumerate(channels):
+            boards.setdefault(channel['adc_name'], []).append(index)
+        boards = [(adcs[name], indexes) for name, indexes in boards.items()]
 
-        # get correct ADC module
+        if threading.current_thread() is threading.main_thread():
+            # own process - terminate() / docker stop unwind the loop so that the energy totals get checkpointed
+            signal.signal(signal.SIGTERM, lambda _signum, _frame: sys.exit(0))
         try:
-            adc_module = importlib.import_module(f"adc.{self.adc_module}")
-            logger.debug(f"Imported {self.adc_module}")
-        except ModuleNotFoundError as e:
-            logger.error(f"Unable to import module {self.adc_module}. Stopping!!")
-            return
+            if self.mode == "rms":
+                self.run_rms(boards, channels)
+            else:
+                self.run_average(boards, channels)
+        finally:
+            self.shutdown()
+        logger.info("done")
+
+    def shutdown(self):
+        if self.energy is not None:
+            self.energy.close()
+
+    def build_channels(self, adcs):
+        # each [[channels]] entry maps an ADC channel to a machine, with optional calibration overrides
+        channels_conf = self.config.get('channels')
+        if not channels_conf:
+            channels_conf = [{"channel": self.config['adc']['channel'], "machine": self.constants['machine']}]
 
-        adc = adc_module.ADC(self.config)
+        channels = []
+        for channel_conf in channels_conf:
+            calculation_conf = {**self.config['calculation'], **channel_conf.get('calculation', {})}
+            adc_name = channel_conf.get('adc', next(iter(adcs)))
+            if adc_name not in adcs:
+                raise ValueError(f"channel {channel_conf['channel']} refers to unknown adc {adc_name}")
+            channels.append({
+                "channel": channel_conf['channel'],
+                "adc_name": adc_name,
+                "adc": adcs[adc_name],
+                "constants": {**self.constants, "machine": channel_conf['machine']},
+                "calculation": calc.PowerMonitoringCalculation({"calculation": calculation_conf}, self.numeric),
+            })
+        logger.info(f"scanning channels {[(c['adc_name'], c['channel'], c['constants']['machine']) for c in channels]}")
+        return channels
+
+    def sample_board(self, adc, channels):
+        # clamp current of each channel, through the calibration lookup table for blocks of raw codes
+        samples = []
+        for channel in channels:
+            if self.block_size > 1:
+                codes = adc.sample_block(self.block_size, channel['channel'])
+                samples.append(channel['calculation'].current_block(codes, adc))
+            else:
+                samples.append(channel['calculation'].current(adc.sample(channel['channel'])))
+        return samples
+
+    def sample_scan(self, boards, channels, pool):
+        # one sample per channel, boards read concurrently on the pool (bus transfers release the GIL)
+        board_channels = [[channels[index] for index in indexes] for _adc, indexes in boards]
+        if pool is None:
+            results = [self.sample_board(boards[0][0], board_channels[0])]
+        else:
+            results = list(pool.map(self.sample_board, [adc for adc, _indexes in boards], board_channels))
+        samples = [0] * len(channels)
+        for (_adc, indexes), values in zip(boards, results):
+            for index, value in zip(indexes, values):
+                samples[index] = value
+        return samples
+
+    def run_average(self, boards, channels):
+        run = True
+        pool = concurrent.futures.ThreadPoolExecutor(len(boards), "adc") if len(boards) > 1 else None
+        schedule = scheduler.Scheduler(self.collection_interval)
+        next_stats = schedule.start + self.stats_interval
 
-        calculation = calc.PowerMonitoringCalculation(self.config)
         num_samples = 0
-        sample_accumulator = 0
+        sample_accumulators = [0] * len(channels)
 
-        sleep_time = period
-        t = time.time()
         while run:
-            t += period
-
-            # Collect samples from ADC
+            # Collect samples from ADC - one reading per channel
+            sample_start = time.perf_counter()
             try:
-                sample = adc.sample()
-                sample_accumulator += sample
+                samples = self.sample_scan(boards, channels, pool)
+                for index, sample in enumerate(samples):
+                    sample_accumulators[index] += sample
                 num_samples+=1
+                if num_samples == 1:
+                    window_start = time.time_ns()
+                self.metrics.observe("adc_sample", time.perf_counter() - sample_start)
             except Exception as e:
+                self.metrics.count("sample_errors")
                 logger.error(f"Sampling lead to exception{e}")
 
-            # handle timestamps and timezones
-            if time.time() > next_check:
-                __dt = -1 * (time.timezone if (time.localtime().tm_isdst == 0) else time.altzone)
-                tz = datetime.timezone(datetime.timedelta(seconds=__dt))
-                # set up next check
-                today = datetime.datetime.now().date()
-                next_check = (datetime.datetime(today.year, today.month, today.day) + datetime.timedelta(
-                    days=1)).timestamp()
-
             # dispatch messages
             if num_samples == self.sample_count:
-                average_sample = sample_accumulator / self.sample_count
-                num_samples = 0
-                sample_accumulator = 0
-
                 # capture timestamp
-                timestamp = datetime.datetime.now(tz=tz).isoformat()
+                timestamp = self.get_timestamp(window_start)
 
                 # convert
-                results = calculation.calculate(average_sample)
-                payload = {**results, **self.constants, "timestamp": timestamp}
+                calculate_start = time.perf_counter()
+                payloads = []
+                for index, channel in enumerate(channels):
+                    average_current = sample_accumulators[index] / self.sample_count
+                    results = channel['calculation'].results(average_current)
+                    payloads.append({**results, **channel['constants'], "timestamp": timestamp})
+                self.metrics.observe("calculate", time.perf_counter() - calculate_start)
+                num_samples = 0
+                sample_accumulators = [0] * len(channels)
 
                 # send
-                output = {"path": "", "payload": payload}
-                self.dispatch(output)
+                self.dispatch_readings(payloads)
+
+            # publish timing statistics
+            if self.stats_interval > 0 and time.monotonic() >= next_stats:
+                next_stats += self.stats_interval
+                self.dispatch_diagnostics("scheduler", schedule.stats())
+                schedule.reset_stats()
+            self.publish_metrics()
 
             # handle sample rate
-            if sleep_time <= 0:
-                logger.warning(f"previous loop took longer that expected by {-sleep_time}s")
-                t = t - sleep_time  # prevent free-wheeling to make up the slack
+            schedule.wait()
 
-            sleep_time = t - time.time()
-            time.sleep(max(0.0, sleep_time))
-        logger.info("done")
+    def run_rms(self, boards, channels):
+        # blocks are captured continuously in the background (one capture thread per board), each report covers
+        # every block captured during the same period the average mode would have used
+        captures = []
+        for adc, indexes in boards:
+            capture = waveform.WaveformCapture(adc, [channels[index]['channel'] for index in indexes],
+                                               self.waveform_block_size, self.waveform_queue_length)
+            capture.start()
+            captures.append((capture, adc, indexes))
+
+        recorders = [None] * len(channels)
+        if self.events_conf.get('enabled', False):
+            writer = events.create_writer()
+            recorders = [events.EventRecorder(channel['constants']['machine'],
+                                              self.events_conf.get('directory', "./data/events"),
+                                              self.events_conf.get('threshold', 0),
+                                              self.events_conf.get('di_dt', 0),
+                                              self.events_conf.get('pre_trigger', 0.5),
+                                              self.events_conf.get('post_trigger', 2),
+                                              self.events_conf.get('holdoff', 10),
+                                              self.fundamental, writer) for channel in channels]
+
+        run = True
+        period = self.collection_interval * self.sample_count
+
+        window_start = None
+        num_blocks = [0] * len(channels)
+        mean_square_accumulators = [0] * len(channels)
+        harmonic_accumulators = [0] * len(channels)
+        peaks = [0] * len(channels)
+
+        next_report = time.monotonic() + period
+        while run:
+            # wait for the first board, then take whatever every board has captured meanwhile
+            wait = True
+            for capture, adc, indexes in captures:
+                while True:
+                    try:
+                        capture_start, blocks = capture.blocks.get(timeout=period if wait else 0)
+                    except queue.Empty:
+                        if wait:
+                            logger.warning(f"no waveform blocks captured in the last {period}s")
+                        break
+                    wait = False
+                    if window_start is None:
+                        window_start = capture_start
+                    block_start = time.perf_counter()
+                    for block, index in zip(blocks, indexes):
+                        mean_square_accumulators[index] += channels[index]['calculation'].mean_square_block(
+                            block, adc.VoltsPerCode, self.remove_offset)
+                        num_blocks[index] += 1
+                    self.metrics.observe("calculate_block", time.perf_counter() - block_start)
+                    if self.power_quality:
+                        spectrum_start = time.perf_counter()
+                        sample_rate = self.quality_sample_rate or capture.sample_rate
+                        for block, index in zip(blocks, indexes):
+                            harmonic_power, peak = channels[index]['calculation'].spectrum_block(
+                                block, adc.VoltsPerCode, sample_rate, self.fundamental, self.harmonics)
+                            harmonic_accumulators[index] += harmonic_power
+                            peaks[index] = max(peaks[index], peak)
+                        self.metrics.observe("spectrum_block", time.perf_counter() - spectrum_start)
+                    if recorders[indexes[0]] is not None:
+                        events_start = time.perf_counter()
+                        sample_rate = self.quality_sample_rate or capture.sample_rate
+                        for block, index in zip(blocks, indexes):
+                            event = recorders[index].add(capture_start, block, adc.VoltsPerCode, sample_rate,
+                                                         channels[index]['calculation'])
+                            if event is not None:
+                                self.dispatch_event(channels[index], event)
+                        self.metrics.observe("events_block", time.perf_counter() - events_start)
+                    if self.ring is not None:
+                        for block, index in zip(blocks, indexes):
+                            self.dispatch_waveform(channels[index], block)
+                    self.metrics.count("blocks")
+                wait = False
+            self.metrics.gauge("capture_queue_depth", sum(capture.blocks.qsize() for capture, _adc, _i in captures))
+            self.metrics.gauge("capture_blocks_dropped", sum(capture.dropped for capture, _adc, _i in captures))
+            self.publish_metrics()
+
+            now = time.monotonic()
+            if now < next_report:
+                continue
+            next_report = max(next_report + period, now)  # prevent free-wheeling to make up the slack
+
+            if window_start is not None:
+                timestamp = self.get_timestamp(window_start)
+
+                calculate_start = time.perf_counter()
+                payloads = []
+                for index, channel in enumerate(channels):
+                    if num_blocks[index] == 0:
+                        continue  # that board captured nothing this period
+                    rms_voltage = math.sqrt(mean_square_accumulators[index] / num_blocks[index])
+                    results = channel['calculation'].calculate_rms(rms_voltage)
+                    if self.power_quality:
+                        results.update(channel['calculation'].power_quality(
+                            harmonic_accumulators[index] / num_blocks[index], peaks[index], rms_voltage))
+                    payloads.append({**results, **channel['constants'], "timestamp": timestamp})
+                self.metrics.observe("calculate", time.perf_counter() - calculate_start)
+                window_start = None
+                num_blocks = [0] * len(channels)
+                mean_square_accumulators = [0] * len(channels)
+                harmonic_accumulators = [0] * len(channels)
+                peaks = [0] * len(channels)
+
+                self.dispatch_readings(payloads)
+
+    def get_timestamp(self, window_start=None):
+        # epoch_ns - integer nanoseconds at the midpoint of the averaging window (window_start is in epoch ns)
+        if self.timestamp_format == "epoch_ns":
+            now = time.time_ns()
+            return now if window_start is None else (window_start + now) // 2
+
+        # handle timestamps and timezones
+        if time.time() > self.next_check:
+            __dt = -1 * (time.timezone if (time.localtime().tm_isdst == 0) else time.altzone)
+            self.tz = datetime.timezone(datetime.timedelta(seconds=__dt))
+            # set up next check
+            today = datetime.datetime.now().date()
+            self.next_check = (datetime.datetime(today.year, today.month, today.day) + datetime.timedelta(
+                days=1)).timestamp()
+
+        return datetime.datetime.now(tz=self.tz).isoformat()
+
+    def dispatch_readings(self, payloads):
+        if self.energy is not None:
+            # running kWh total, in the same representation (float or string) as power
+            now = time.monotonic()
+            for payload in payloads:
+                power = payload['power']
+                payload['energy'] = type(power)(self.energy.add(payload['machine'], float(power), now))
+        if self.aggregator is not None:
+            self.dispatch_aggregates(payloads)
+
+        if self.exceptions is not None:
+            # report by exception - energy and aggregates above still see every reading
+            now = time.monotonic()
+            published = [payload for payload in payloads
+                         if self.exceptions.should_publish(payload['machine'], payload, now)]
+            self.metrics.count("readings_suppressed", len(payloads) - len(published))
+            if not published:
+                return
+            payloads = published
+
+        # a single reading keeps the original message layout, a scan of several channels goes out as one message
+        if len(payloads) == 1:
+            output = {"path": "", "payload": payloads[0]}
+        else:
+            output = {"path": "", "payloads": payloads}
+        self.dispatch(output)
+
+    def dispatch_aggregates(self, payloads):
+        # roll the readings up into each window, windows that have just closed go out as JSON with native numbers
+        now = time.time()
+        summaries = []
+        for payload in payloads:
+            for summary in self.aggregator.add(payload['machine'], payload, now):
+                start = summary.pop("start")
+                summaries.append({**summary, "machine": payload['machine'], "timestamp": self.format_timestamp(start)})
+        if summaries:
+            self.dispatch({"path": aggregate.aggregate_path, "payloads": summaries, "format": "json",
+                           "measurement": aggregate.measurement})
+
+    def format_timestamp(self, epoch_seconds):
+        if self.timestamp_format == "epoch_ns":
+            return round(epoch_seconds * 1000000000)
+        return datetime.datetime.fromtimestamp(epoch_seconds).astimezone().isoformat()
+
+    def dispatch_event(self, channel, event):
+        # summary of a triggered capture, JSON with native numbers, timestamped at the trigger
+        trigger_ns = event.pop("trigger_ns")
+        payload = {**event, **channel['constants'], "timestamp": self.format_timestamp(trigger_ns / 1e9)}
+        logger.warning(f"{event['reason']} event on {channel['constants']['machine']}: {event['current_max']:.2f} A")
+        self.metrics.count("events")
+        self.dispatch({"path": events.event_path, "payload": payload, "format": "json",
+                       "measurement": events.measurement})
+
+    def dispatch_diagnostics(self, name, stats):
+        payload = {**stats, **self.constants, "timestamp": self.get_timestamp()}
+        self.dispatch({"path": metrics.diagnostics_path + name, "payload": payload, "format": "json"})
+
+    def publish_metrics(self):
+        if self.metrics_interval <= 0 or time.monotonic() < self.next_metrics:
+            return
+        self.next_metrics += self.metrics_interval
+        self.dispatch_diagnostics("measure_metrics", self.metrics.snapshot())
+
+    def dispatch_waveform(self, channel, block):
+        # the samples go through shared memory, only the slot sequence number and a small payload use ZMQ
+        sequence = self.ring.write(block)
+        if sequence is None:
+            self.waveform_dropped += 1
+            self.metrics.count("waveform_dropped")
+            logger.warning(f"waveform ring buffer full, {self.waveform_dropped} blocks dropped so far")
+            return
+        payload = {**channel['constants'], "timestamp": self.get_timestamp()}
+        self.dispatch({"path": waveform_path, "block": sequence, "payload": payload})
 
     def dispatch(self, output):
-        logger.info(f"dispatch to { output['path']} of {output['payload']}")
-        self.zmq_out.send_json({'path': output.get('path', ""), 'payload': output['payload']})
+        dispatch_start = time.perf_counter()
+        key = 'payloads' if 'payloads' in output else 'payload'
+        logger.info(f"dispatch to { output['path']} of {output[key]}")
+        message = {'path': output.get('path', ""), key: output[key], 'sent': time.monotonic()}
+        for optional in ('block', 'format', 'measurement'):
+            if optional in output:
+                message[optional] = output[optional]
+        if self.overflow == "block":
+            self.zmq_out.send_json(message)
+        else:
+            self.send(message)
+        self.metrics.count("messages_sent")
+        self.metrics.observe("dispatch", time.perf_counter() - dispatch_start)
+
+    def send(self, message):
+        # never blocks the sampling loop - anything ZMQ won't take right now waits in a bounded backlog, which is
+        # retried (oldest first) on every dispatch
+        self.flush_backlog()
+        if not self.backlog and self.try_send(message):
+            return
+
+        if self.overflow == "coalesce" and message['path'] not in (events.event_path, waveform_path):
+            # only the latest message of each kind (readings, each diagnostics name, ...) per machine (and aggregate
+            # window) is kept - the path is still the unrendered topic template, the same for every channel. Event
+            # summaries and waveform blocks are not state that a later message supersedes, each one is kept
+            payloads = message['payloads'] if 'payloads' in message else [message['payload']]
+            key = (message['path'], *((payload.get('machine'), payload.get('window')) for payload in payloads))
+            if self.backlog.pop(key, None) is not None:
+                self.metrics.count("messages_coalesced")
+        else:
+            key = self.backlog_key
+            self.backlog_key += 1
+        if len(self.backlog) >= self.backlog_limit:
+            if self.overflow == "drop_newest":
+                self.metrics.count("messages_dropped")
+                return
+            self.backlog.popitem(last=False)
+            self.metrics.count("messages_dropped")
+        self.backlog[key] = message
+        self.metrics.gauge("send_backlog", len(self.backlog))
+
+    def flush_backlog(self):
+        while self.backlog:
+            key, message = next(iter(self.backlog.items()))
+            if not self.try_send(message):
+                break
+            del self.backlog[key]
+        self.metrics.gauge("send_backlog", len(self.backlog))
+
+    def try_send(self, message):
+        try:
+            self.zmq_out.send_json(message, zmq.NOBLOCK)
+            return True
+        except zmq.Again:
+            return False
@@ -0,0 +1,115 @@
+# ----------------------------------------------------------------------
+#
+#    Power Monitoring (Basic solution) -- This digital solution measures,
+#    reports and records both AC power and current consumed by an electrical 
+#    equipment, so that its energy consumption can be understood and 
+#    taken action upon. This version comes with one current transformer 
+#    clamp of 20A that is buckled up to the electric line the equipment 
+#    is connected to. The solution provides a Grafana dashboard that 
+#    displays current and power consumption, and an InfluxDB database 
+#    to store timestamp, current and power. 
+#
+#    Copyright (C) 2022  Shoestring and University of Cambridge
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3 of the License.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see https://www.gnu.org/licenses/.
+#
+# ----------------------------------------------------------------------
+
+import bisect
+import http.server
+import logging
+import threading
+
+logger = logging.getLogger("main.metrics")
+
+# diagnostics are published below the base topic, e.g. power_monitoring/diagnostics/Machine_1/scheduler
+diagnostics_path = "diagnostics/{{machine}}/"
+
+
+class Metrics:
+    # Cheap always-on counters, gauges and latency histograms for one building block.
+    # Callers time stages with time.perf_counter() pairs and observe() the difference - a bisect and two
+    # additions per observation. Snapshots go out as diagnostics messages and/or Prometheus text.
+    bounds = [0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0]
+
+    def __init__(self, component):
+        self.component = component
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}  # name -> [bucket counts..., +Inf count, sum]
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = [0] * (len(self.bounds) + 2)
+        histogram[bisect.bisect_left(self.bounds, seconds)] += 1
+        histogram[-1] += seconds
+
+    def snapshot(self):
+        histograms = {}
+        for name, histogram in dict(self.histograms).items():
+            histogram = list(histogram)
+            buckets = {f"le_{bound:g}": count for bound, count in zip(self.bounds, histogram)}
+            buckets["le_inf"] = histogram[len(self.bounds)]
+            histograms[name] = {"count": sum(histogram[:-1]), "sum": histogram[-1], "buckets": buckets}
+        return {"component": self.component, "counters": dict(self.counters), "gauges": dict(self.gauges),
+                "histograms": histograms}
+
+    def prometheus(self):
+        prefix = f"power_monitoring_{self.component}"
+        lines = []
+        for name, value in dict(self.counters).items():
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {value}")
+        for name, value in dict(self.gauges).items():
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.append(f"{prefix}_{name} {value}")
+        for name, histogram in dict(self.histograms).items():
+            histogram = list(histogram)
+            lines.append(f"# TYPE {prefix}_{name}_seconds histogram")
+            cumulative = 0
+            for bound, count in zip(self.bounds, histogram):
+                cumulative += count
+                lines.append(f'{prefix}_{name}_seconds_bucket{{le="{bound:g}"}} {cumulative}')
+            cumulative += histogram[len(self.bounds)]
+            lines.append(f'{prefix}_{name}_seconds_bucket{{le="+Inf"}} {cumulative}')
+            lines.append(f"{prefix}_{name}_seconds_sum {histogram[-1]}")
+            lines.append(f"{prefix}_{name}_seconds_count {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port):
+        # Prometheus style /metrics endpoint on a daemon thread
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info(f"{self.component} metrics served on port {port}")
+        return server
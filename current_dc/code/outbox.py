@@ -0,0 +1,77 @@
+# ----------------------------------------------------------------------
+#
+#    Power Monitoring (Basic solution) -- This digital solution measures,
+#    reports and records both AC power and current consumed by an electrical 
+#    equipment, so that its energy consumption can be understood and 
+#    taken action upon. This version comes with one current transformer 
+#    clamp of 20A that is buckled up to the electric line the equipment 
+#    is connected to. The solution provides a Grafana dashboard that 
+#    displays current and power consumption, and an InfluxDB database 
+#    to store timestamp, current and power. 
+#
+#    Copyright (C) 2022  Shoestring and University of Cambridge
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3 of the License.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see https://www.gnu.org/licenses/.
+#
+# ----------------------------------------------------------------------
+
+import logging
+import os
+import sqlite3
+
+logger = logging.getLogger("main.outbox")
+
+
+class Outbox:
+    # persistent FIFO of (topic, payload) waiting for the broker - SQLite in WAL mode so a power cut loses at most
+    # the last transaction. Bounded by max_messages, the oldest entries are dropped first.
+    def __init__(self, path, max_messages=100000):
+        self.max_messages = max_messages
+        self.dropped = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT, payload BLOB)")
+        self.pending = self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        if self.pending:
+            logger.info(f"{self.pending} messages waiting in the outbox from a previous run")
+
+    def __len__(self):
+        return self.pending
+
+    def put(self, topic, payload):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.db.execute("INSERT INTO outbox (topic, payload) VALUES (?, ?)", (topic, payload))
+        self.pending += 1
+        if self.pending > self.max_messages:
+            excess = self.pending - self.max_messages
+            self.db.execute("DELETE FROM outbox WHERE id IN (SELECT id FROM outbox ORDER BY id LIMIT ?)", (excess,))
+            self.pending -= excess
+            self.dropped += excess
+
+    def peek(self, n):
+        # oldest n entries as (id, topic, payload)
+        return self.db.execute("SELECT id, topic, payload FROM outbox ORDER BY id LIMIT ?", (n,)).fetchall()
+
+    def remove(self, last_id):
+        # drop everything up to and including last_id once it has been handed to the client
+        removed = self.db.execute("DELETE FROM outbox WHERE id <= ?", (last_id,)).rowcount
+        self.pending -= removed
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,107 @@
+# ----------------------------------------------------------------------
+#
+#    Power Monitoring (Basic solution) -- This digital solution measures,
+#    reports and records both AC power and current consumed by an electrical 
+#    equipment, so that its energy consumption can be understood and 
+#    taken action upon. This version comes with one current transformer 
+#    clamp of 20A that is buckled up to the electric line the equipment 
+#    is connected to. The solution provides a Grafana dashboard that 
+#    displays current and power consumption, and an InfluxDB database 
+#    to store timestamp, current and power. 
+#
+#    Copyright (C) 2022  Shoestring and University of Cambridge
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3 of the License.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see https://www.gnu.org/licenses/.
+#
+# ----------------------------------------------------------------------
+
+import logging
+from multiprocessing import shared_memory
+
+import numpy as np
+
+logger = logging.getLogger("main.ringbuffer")
+
+
+class SharedRingBuffer:
+    # Single producer / single consumer ring of fixed size sample blocks in shared memory, used to hand raw
+    # waveform blocks from the measure process to the wrapper without serialising them through ZMQ.
+    # The producer only ever advances the write counter and the consumer only the read counter, so no lock is
+    # needed. Counters are 32 bit (atomic stores on 32 bit Pi OS too) and wrap, hence the power of two slots.
+    dtype = np.int32
+    header_size = 64
+    counter_mask = 0xFFFFFFFF
+
+    def __init__(self, slots, slot_size, name=None, create=True):
+        if slots <= 0 or slots & (slots - 1):
+            raise ValueError(f"ring buffer slots must be a power of two, got {slots}")
+        self.slots = slots
+        self.slot_size = slot_size
+
+        lengths_size = 4 * slots
+        data_size = slots * slot_size * np.dtype(self.dtype).itemsize
+        self.shm = shared_memory.SharedMemory(name=name, create=create,
+                                              size=self.header_size + lengths_size + data_size)
+        buf = self.shm.buf
+        self.counters = np.ndarray((2,), dtype=np.uint32, buffer=buf)  # [write, read]
+        self.lengths = np.ndarray((slots,), dtype=np.uint32, buffer=buf, offset=self.header_size)
+        self.data = np.ndarray((slots, slot_size), dtype=self.dtype, buffer=buf,
+                               offset=self.header_size + lengths_size)
+        if create:
+            self.counters[:] = 0
+            logger.info(f"created shared ring buffer {self.shm.name}: {slots} x {slot_size} samples")
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def pending(self):
+        return (int(self.counters[0]) - int(self.counters[1])) & self.counter_mask
+
+    # producer side
+
+    def write(self, block):
+        # copies the block into the next free slot and returns its sequence number, or None if the ring is full
+        if self.pending() >= self.slots:
+            return None
+        if len(block) > self.slot_size:
+            raise ValueError(f"block of {len(block)} samples does not fit in a {self.slot_size} sample slot")
+
+        sequence = int(self.counters[0])
+        slot = sequence % self.slots
+        self.data[slot, :len(block)] = block
+        self.lengths[slot] = len(block)
+        self.counters[0] = (sequence + 1) & self.counter_mask  # publish only once the data is in place
+        return sequence
+
+    # consumer side
+
+    def read(self):
+        # returns (sequence, block) for the oldest unread slot, or None if the ring is empty.
+        # The block is a view into shared memory that stays valid until release() is called.
+        sequence = int(self.counters[1])
+        if sequence == int(self.counters[0]):
+            return None
+        slot = sequence % self.slots
+        return sequence, self.data[slot, :self.lengths[slot]]
+
+    def release(self):
+        self.counters[1] = (int(self.counters[1]) + 1) & self.counter_mask
+
+    def close(self):
+        # numpy views hold exported buffers, these have to go before the mapping can be closed
+        self.counters = self.lengths = self.data = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
@@ -0,0 +1,99 @@
+# ----------------------------------------------------------------------
+#
+#    Power Monitoring (Basic solution) -- This digital solution measures,
+#    reports and records both AC power and current consumed by an electrical 
+#    equipment, so that its energy consumption can be understood and 
+#    taken action upon. This version comes with one current transformer 
+#    clamp of 20A that is buckled up to the electric line the equipment 
+#    is connected to. The solution provides a Grafana dashboard that 
+#    displays current and power consumption, and an InfluxDB database 
+#    to store timestamp, current and power. 
+#
+#    Copyright (C) 2022  Shoestring and University of Cambridge
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3 of the License.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see https://www.gnu.org/licenses/.
+#
+# ----------------------------------------------------------------------
+
+import logging
+import time
+
+logger = logging.getLogger("main.measure.scheduler")
+
+
+class Scheduler:
+    # Phase-locked periodic scheduler on the monotonic clock.
+    # Sample instants are always start + n * period. An overrun skips the slots it missed and counts them,
+    # rather than sliding the schedule. Wake-up jitter is kept in a histogram with bucket bounds in seconds.
+    histogram_bounds = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1]
+
+    def __init__(self, period):
+        self.period = period
+        self.start = time.monotonic()
+        self.tick = 0
+
+        self.ticks_total = 0
+        self.missed_total = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.ticks = 0
+        self.missed = 0
+        self.jitter_sum = 0.0
+        self.jitter_max = 0.0
+        self.histogram = [0] * (len(self.histogram_bounds) + 1)
+
+    def wait(self):
+        # block until the next sample instant and return it (monotonic time)
+        self.tick += 1
+        target = self.start + self.tick * self.period
+        now = time.monotonic()
+
+        if now >= target + self.period:
+            skipped = int((now - target) // self.period)
+            if self.missed == 0:  # once per statistics interval, the rest are only counted
+                logger.warning(f"previous loop took longer than expected by {now - target}s, skipping {skipped} samples")
+            self.tick += skipped
+            self.missed += skipped
+            self.missed_total += skipped
+            target += skipped * self.period
+
+        if now < target:
+            time.sleep(target - now)
+
+        jitter = time.monotonic() - target
+        self.ticks += 1
+        self.ticks_total += 1
+        self.jitter_sum += jitter
+        self.jitter_max = max(self.jitter_max, jitter)
+        for index, bound in enumerate(self.histogram_bounds):
+            if jitter <= bound:
+                self.histogram[index] += 1
+                break
+        else:
+            self.histogram[-1] += 1
+        return target
+
+    def stats(self):
+        histogram = {f"le_{bound * 1e6:g}us": count for bound, count in zip(self.histogram_bounds, self.histogram)}
+        histogram[f"gt_{self.histogram_bounds[-1] * 1e6:g}us"] = self.histogram[-1]
+        return {
+            "period": self.period,
+            "ticks": self.ticks,
+            "missed": self.missed,
+            "ticks_total": self.ticks_total,
+            "missed_total": self.missed_total,
+            "jitter_mean": self.jitter_sum / self.ticks if self.ticks else 0.0,
+            "jitter_max": self.jitter_max,
+            "histogram": histogram,
+        }
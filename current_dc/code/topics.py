@@ -0,0 +1,75 @@
+# ----------------------------------------------------------------------
+#
+#    Power Monitoring (Basic solution) -- This digital solution measures,
+#    reports and records both AC power and current consumed by an electrical 
+#    equipment, so that its energy consumption can be understood and 
+#    taken action upon. This version comes with one current transformer 
+#    clamp of 20A that is buckled up to the electric line the equipment 
+#    is connected to. The solution provides a Grafana dashboard that 
+#    displays current and power consumption, and an InfluxDB database 
+#    to store timestamp, current and power. 
+#
+#    Copyright (C) 2022  Shoestring and University of Cambridge
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3 of the License.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see https://www.gnu.org/licenses/.
+#
+# ----------------------------------------------------------------------
+
+import collections
+import chevron
+from chevron.tokenizer import tokenize
+from urllib.parse import urljoin
+
+
+class TopicResolver:
+    # renders base_topic_template + message path, caching the result by path and the values it depends on
+    def __init__(self, base, constants, max_size=1024):
+        self.base = base
+        self.constants = constants
+        self.max_size = max_size
+        self.templates = {}  # path -> (template, variable names or None when it can't be cached)
+        self.topics = collections.OrderedDict()
+        self.misses = 0
+
+    def compile(self, path):
+        template = urljoin(self.base, path)
+        names = []
+        for tag, key in tokenize(template):
+            if tag in ('variable', 'no escape') and '.' not in key:
+                names.append(key)
+            elif tag not in ('literal', 'comment'):
+                # sections, partials and dotted names depend on more than a flat lookup - always render
+                names = None
+                break
+        entry = self.templates[path] = (template, None if names is None else tuple(names))
+        return entry
+
+    def resolve(self, path, payload):
+        template, names = self.templates.get(path) or self.compile(path)
+        if names is None:
+            return chevron.render(template, {**self.constants, **payload})
+
+        constants = self.constants
+        key = (path, *[payload[name] if name in payload else constants.get(name) for name in names])
+        try:
+            topic = self.topics.get(key)
+        except TypeError:  # unhashable value
+            return chevron.render(template, {**constants, **payload})
+        if topic is None:
+            self.misses += 1
+            topic = self.topics[key] = chevron.render(template, {**constants, **payload})
+            if len(self.topics) > self.max_size:
+                self.topics.popitem(last=False)
+        else:
+            self.topics.move_to_end(key)
+        return topic
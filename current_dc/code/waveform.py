@@ -0,0 +1,66 @@
+# ----------------------------------------------------------------------
+#
+#    Power Monitoring (Basic solution) -- This digital solution measures,
+#    reports and records both AC power and current consumed by an electrical 
+#    equipment, so that its energy consumption can be understood and 
+#    taken action upon. This version comes with one current transformer 
+#    clamp of 20A that is buckled up to the electric line the equipment 
+#    is connected to. The solution provides a Grafana dashboard that 
+#    displays current and power consumption, and an InfluxDB database 
+#    to store timestamp, current and power. 
+#
+#    Copyright (C) 2022  Shoestring and University of Cambridge
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3 of the License.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see https://www.gnu.org/licenses/.
+#
+# ----------------------------------------------------------------------
+
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger("main.measure.waveform")
+
+
+class WaveformCapture(threading.Thread):
+    # continuously captures blocks of raw codes so that capture carries on while the measure loop
+    # converts and dispatches the previous block - each queue entry holds the capture start time (epoch ns)
+    # and one block per channel
+    def __init__(self, adc, channels, block_size, queue_length):
+        super().__init__(daemon=True)
+        self.adc = adc
+        self.channels = channels
+        self.block_size = block_size
+        self.blocks = queue.Queue(maxsize=queue_length)
+        self.dropped = 0
+        self.sample_rate = 0  # samples per second within a block, measured from the last capture
+
+    def run(self):
+        logger.info(f"capturing blocks of {self.block_size} samples on channels {self.channels}")
+        while True:
+            try:
+                start_ns = time.time_ns()
+                read_start = time.perf_counter()
+                codes = [self.adc.sample_block(self.block_size, channel) for channel in self.channels]
+                self.sample_rate = self.block_size * len(self.channels) / (time.perf_counter() - read_start)
+            except Exception as e:
+                logger.error(f"Block sampling lead to exception {e}")
+                time.sleep(0.1)
+                continue
+
+            try:
+                self.blocks.put_nowait((start_ns, codes))
+            except queue.Full:
+                self.dropped += 1
+                logger.warning(f"measure loop is falling behind, {self.dropped} blocks dropped so far")
@@ -26,93 +26,342 @@
 # ----------------------------------------------------------------------
 
 import paho.mqtt.client as mqtt
+import datetime
 import multiprocessing
 import logging
 import zmq
 import json
-import chevron
 import time
-from urllib.parse import urljoin
 
-context = zmq.Context()
+import encoding
+import metrics
+import outbox
+import topics
+
+context = zmq.Context.instance()  # shared by every building block in the process, as inproc:// requires
 logger = logging.getLogger("main.wrapper")
 
 
 class MQTTServiceWrapper(multiprocessing.Process):
-    def __init__(self, config, zmq_conf):
+    def __init__(self, config, zmq_conf, ring=None):
         super().__init__()
 
         mqtt_conf = config['mqtt']
         self.url = mqtt_conf['broker']
         self.port = int(mqtt_conf['port'])
 
-        self.topic_base = mqtt_conf['base_topic_template']
+        self.topics = topics.TopicResolver(mqtt_conf['base_topic_template'], config['constants'],
+                                           mqtt_conf.get('topic_cache_size', 1024))
+        self.encode = encoding.get_encoder(mqtt_conf.get('encoding', "json_string"),
+                                           mqtt_conf.get('measurement', "equipment_power_usage"))
+        self.encode_batch = encoding.get_batch_encoder(mqtt_conf.get('encoding', "json_string"),
+                                                       mqtt_conf.get('measurement', "equipment_power_usage"))
+
+        # readings batched per topic: topic -> [deadline, payloads]
+        self.batch_size = mqtt_conf.get('batch_size', 1)
+        self.linger = mqtt_conf.get('linger', 1.0)
+        self.batches = {}
 
         self.initial = mqtt_conf['reconnect']['initial']
         self.backoff = mqtt_conf['reconnect']['backoff']
         self.limit = mqtt_conf['reconnect']['limit']
+        # connection state - reconnects are attempted from the event loop rather than blocking in a callback
+        self.connected = False
+        self.timeout = self.initial
+        self.reconnect_at = None
         self.constants = config['constants']
+        self.timestamp_format = config['sampling'].get('timestamp_format', "iso")
 
         # declarations
         self.zmq_conf = zmq_conf
         self.zmq_in = None
+        self.ring = ring
+
+        # messages published while the broker is unreachable are stored and forwarded on reconnect
+        outbox_conf = config.get('outbox', {})
+        self.outbox_path = outbox_conf.get('path', "")
+        self.outbox_max = outbox_conf.get('max_messages', 100000)
+        self.drain_rate = outbox_conf.get('drain_rate', 100)
+        if self.outbox_path and not self.drain_rate > 0:
+            raise ValueError(f"outbox.drain_rate must be greater than 0, got {self.drain_rate}")
+        self.drain_batch = outbox_conf.get('drain_batch', 500)
+        self.outbox = None
+        self.drain_credit = 0
+        self.drain_owed = 0  # messages stored behind the backlog since the last drain, forwarded on top of drain_rate
+        self.last_drain = 0
+
+        metrics_conf = config.get('metrics', {})
+        self.metrics = metrics.Metrics("wrapper")
+        self.metrics_interval = metrics_conf.get('interval', 0)
+        self.metrics_port = metrics_conf.get('wrapper_http_port', 0)
 
     def do_connect(self):
         self.zmq_in = context.socket(self.zmq_conf['type'])
+        self.zmq_in.setsockopt(zmq.RCVHWM, self.zmq_conf.get('hwm', 1000))
         if self.zmq_conf["bind"]:
             self.zmq_in.bind(self.zmq_conf["address"])
         else:
             self.zmq_in.connect(self.zmq_conf["address"])
 
     def mqtt_connect(self, client, first_time=False):
-        timeout = self.initial
-        exceptions = True
-        while exceptions:
-            try:
-                if first_time:
-                    client.connect(self.url, self.port, 60)
-                else:
-                    logger.error("Attempting to reconnect...")
-                    client.reconnect()
-                logger.info("Connected!")
-                time.sleep(self.initial)  # to give things time to settle
-                exceptions = False
-            except Exception:
-                logger.error(f"Unable to connect, retrying in {timeout} seconds")
-                time.sleep(timeout)
-                if timeout < self.limit:
-                    timeout = timeout * self.backoff
-                else:
-                    timeout = self.limit
+        # a single attempt, a failure schedules the next one with backoff
+        try:
+            if first_time:
+                client.connect(self.url, self.port, 60)
+            else:
+                logger.error("Attempting to reconnect...")
+                client.reconnect()
+            self.reconnect_at = None
+        except Exception:
+            logger.error(f"Unable to connect, retrying in {self.timeout} seconds")
+            self.reconnect_at = time.monotonic() + self.timeout
+            if self.timeout < self.limit:
+                self.timeout = self.timeout * self.backoff
+            else:
+                self.timeout = self.limit
+
+    def on_connect(self, _client, _userdata, _flags, rc):
+        if rc != 0:
+            logger.error(f"MQTT connection refused (rc:{rc})")
+            return
+        logger.info("Connected!")
+        self.connected = True
+        self.timeout = self.initial
+        self.metrics.count("mqtt_connects")
+        self.last_drain = time.monotonic()
+        self.drain_credit = 0
+        self.drain_owed = 0
 
     def on_disconnect(self, client, _userdata, rc):
+        self.connected = False
         if rc != 0:
             logger.error(f"Unexpected MQTT disconnection (rc:{rc}), reconnecting...")
-            self.mqtt_connect(client)
+            self.reconnect_at = time.monotonic()
 
     def run(self):
         self.do_connect()
 
         client = mqtt.Client()
-        # client.on_connect = self.on_connect
+        client.on_connect = self.on_connect
         # client.on_message = self.on_message
         client.on_disconnect = self.on_disconnect
+        client.on_publish = self.on_publish
+
+        if self.metrics_port:
+            self.metrics.serve(self.metrics_port)
+        next_metrics = time.monotonic() + self.metrics_interval
 
         # self.client.tls_set('ca.cert.pem',tls_version=2)
         logger.info(f'connecting to {self.url}:{self.port}')
+        if self.outbox_path:
+            self.outbox = outbox.Outbox(self.outbox_path, self.outbox_max)
         self.mqtt_connect(client, True)
 
-        run = True
-        while run:
-            while self.zmq_in.poll(50, zmq.POLLIN):
-                try:
-                    msg = self.zmq_in.recv(zmq.NOBLOCK)
-                    msg_json = json.loads(msg)
-                    msg_path = msg_json['path']
-                    msg_payload = msg_json['payload']
-                    topic = chevron.render(urljoin(self.topic_base, msg_path), {**msg_payload, **self.constants})
-                    logger.debug(f'pub topic:{topic} msg:{msg_payload}')
-                    client.publish(topic, json.dumps(msg_payload))
-                except zmq.ZMQError:
-                    pass
-            client.loop(0.05)
+        # one wait on both the ZMQ socket and the MQTT socket, so readings are published as soon as they arrive
+        poller = zmq.Poller()
+        poller.register(self.zmq_in, zmq.POLLIN)
+        mqtt_sock = (None, None)
+
+        while True:
+            if self.reconnect_at is not None and self.reconnect_at <= time.monotonic():
+                self.mqtt_connect(client)
+            mqtt_sock = self.register_mqtt_socket(poller, client, mqtt_sock)
+            events = dict(poller.poll(self.poll_timeout(next_metrics) * 1000))
+
+            # plain sockets are reported by file descriptor
+            mqtt_events = events.get(mqtt_sock[1], 0)
+            if mqtt_events & zmq.POLLIN:
+                client.loop_read()
+            if mqtt_events & zmq.POLLOUT:
+                client.loop_write()
+
+            if self.zmq_in in events:
+                backlog = 0
+                while True:
+                    try:
+                        msg = self.zmq_in.recv(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    backlog += 1
+                    self.handle_message(client, msg)
+                # messages drained in one wake-up - how far the wrapper had fallen behind the measure process
+                self.metrics.gauge("zmq_backlog_max", max(backlog, self.metrics.gauges.get("zmq_backlog_max", 0)))
+
+            self.flush_batches(client)
+            if self.outbox is not None:
+                self.drain_outbox(client)
+            if 0 < self.metrics_interval and next_metrics <= time.monotonic():
+                next_metrics += self.metrics_interval
+                self.publish_metrics(client)
+
+            # keepalive pings and QoS retries
+            client.loop_misc()
+
+    def register_mqtt_socket(self, poller, client, registered):
+        # paho opens a new socket on every reconnect - registered is the (socket, fd) pair being polled
+        sock = client.socket()
+        fd = registered[1]
+        if sock is not registered[0]:
+            if fd is not None:
+                poller.unregister(fd)
+            fd = sock.fileno() if sock is not None else None
+            if fd is not None:
+                poller.register(fd, zmq.POLLIN)
+        if fd is not None:
+            # only wait for writability while paho has packets it could not send straight away
+            poller.modify(fd, zmq.POLLIN | zmq.POLLOUT if client.want_write() else zmq.POLLIN)
+        return sock, fd
+
+    def poll_timeout(self, next_metrics):
+        # sleep until the next batch deadline or metrics publish, waking at least once a second for loop_misc
+        wake = time.monotonic() + 1.0
+        if 0 < self.metrics_interval:
+            wake = min(wake, next_metrics)
+        for deadline, _payloads in self.batches.values():
+            wake = min(wake, deadline)
+        if self.reconnect_at is not None:
+            wake = min(wake, self.reconnect_at)
+        if self.connected and self.outbox is not None and len(self.outbox):
+            wake = min(wake, time.monotonic() + 1 / self.drain_rate)
+        return max(0.0, wake - time.monotonic())
+
+    def handle_message(self, client, msg):
+        decode_start = time.perf_counter()
+        msg_json = json.loads(msg)
+        self.metrics.observe("decode", time.perf_counter() - decode_start)
+        self.metrics.count("messages_received")
+        if 'sent' in msg_json:
+            self.metrics.observe("zmq_queue_wait", time.monotonic() - msg_json['sent'])
+
+        msg_path = msg_json['path']
+        # readings use the configured encoding and may be batched, diagnostics, aggregates and events are always
+        # single JSON objects
+        reading = msg_json.get('format') != "json" and 'block' not in msg_json
+        encode = self.encode if reading else json.dumps
+        # a multi-channel scan carries one payload per machine
+        msg_payloads = msg_json['payloads'] if 'payloads' in msg_json else [msg_json['payload']]
+        for msg_payload in msg_payloads:
+            render_start = time.perf_counter()
+            topic = self.topics.resolve(msg_path, msg_payload)
+            self.metrics.observe("render", time.perf_counter() - render_start)
+            if 'block' in msg_json:
+                self.publish_waveform(client, topic, msg_json['block'])
+                continue
+            logger.debug(f'pub topic:{topic} msg:{msg_payload}')
+            if self.batch_size > 1 and reading:
+                self.add_to_batch(client, topic, msg_payload)
+            else:
+                self.publish(client, topic, encode(msg_payload))
+
+    def add_to_batch(self, client, topic, payload):
+        batch = self.batches.get(topic)
+        if batch is None:
+            batch = self.batches[topic] = [time.monotonic() + self.linger, []]
+        batch[1].append(payload)
+        if len(batch[1]) >= self.batch_size:
+            del self.batches[topic]
+            self.publish_batch(client, topic, batch[1])
+
+    def flush_batches(self, client):
+        # publish every batch that has lingered long enough
+        now = time.monotonic()
+        for topic, (deadline, payloads) in list(self.batches.items()):
+            if deadline <= now:
+                del self.batches[topic]
+                self.publish_batch(client, topic, payloads)
+
+    def publish_batch(self, client, topic, payloads):
+        self.metrics.count("batches")
+        self.metrics.count("batched_readings", len(payloads))
+        self.publish(client, topic, self.encode_batch(payloads))
+
+    def publish(self, client, topic, payload, store=True):
+        # while disconnected or still forwarding a backlog, new messages queue behind it to keep them in order -
+        # apart from store=False ones (raw waveform blocks), which are dropped rather than crowd readings out
+        if self.outbox is not None and (not self.connected or len(self.outbox)):
+            if store:
+                self.store(topic, payload)
+                if self.connected:
+                    self.drain_owed += 1
+            else:
+                self.metrics.count("outbox_not_stored")
+            return
+        publish_start = time.perf_counter()
+        info = client.publish(topic, payload)
+        self.metrics.observe("publish", time.perf_counter() - publish_start)
+        self.metrics.count("mqtt_published")
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            self.metrics.count("mqtt_publish_errors")
+            if self.outbox is not None and store:
+                self.store(topic, payload)
+
+    def store(self, topic, payload):
+        dropped = self.outbox.dropped
+        self.outbox.put(topic, payload)
+        self.metrics.count("outbox_stored")
+        if self.outbox.dropped != dropped:
+            self.metrics.count("outbox_dropped", self.outbox.dropped - dropped)
+
+    def drain_outbox(self, client):
+        # forward stored messages oldest first - every message that arrived meanwhile plus drain_rate a second, so
+        # the backlog shrinks whatever the incoming rate and publishing goes direct again once it is empty
+        if not self.connected or not len(self.outbox) or client.want_write():
+            return
+        now = time.monotonic()
+        self.drain_credit = min(self.drain_batch, self.drain_credit + (now - self.last_drain) * self.drain_rate)
+        self.last_drain = now
+        last_id = None
+        for message_id, topic, payload in self.outbox.peek(self.drain_owed + int(self.drain_credit)):
+            if client.publish(topic, payload).rc != mqtt.MQTT_ERR_SUCCESS:
+                break
+            last_id = message_id
+            if self.drain_owed:
+                self.drain_owed -= 1
+            else:
+                self.drain_credit -= 1
+            self.metrics.count("outbox_forwarded")
+        if last_id is not None:
+            self.outbox.remove(last_id)
+
+    def on_publish(self, _client, _userdata, _mid):
+        # called once a QoS 0 message has been written out or a QoS 1/2 message acknowledged
+        self.metrics.count("mqtt_acked")
+
+    def publish_metrics(self, client):
+        self.metrics.gauge("topic_cache_size", len(self.topics.topics))
+        self.metrics.gauge("topic_cache_misses", self.topics.misses)
+        if self.outbox is not None:
+            self.metrics.gauge("outbox_pending", len(self.outbox))
+        topic = self.topics.resolve(metrics.diagnostics_path + "wrapper_metrics", {})
+        if self.timestamp_format == "epoch_ns":
+            timestamp = time.time_ns()
+        else:
+            timestamp = datetime.datetime.now().astimezone().isoformat()
+        payload = {**self.metrics.snapshot(), **self.constants, "timestamp": timestamp}
+        self.publish(client, topic, json.dumps(payload))
+        self.metrics.gauge("zmq_backlog_max", 0)
+
+    def publish_waveform(self, client, topic, sequence):
+        # raw sample block from the shared memory ring, published as little-endian int32 codes
+        if self.ring is None:
+            logger.error("received a waveform block but no shared memory ring is configured")
+            return
+        entry = self.ring.read()
+        # blocks whose messages the measure process dropped under backpressure are still in the ring - skip them
+        while entry is not None and entry[0] != sequence and (sequence - entry[0]) % 2 ** 32 < 2 ** 31:
+            self.ring.release()
+            self.metrics.count("waveform_skipped")
+            entry = self.ring.read()
+        if entry is None:
+            logger.error(f"waveform block {sequence} missing from the ring buffer")
+            return
+        ring_sequence, block = entry
+        if ring_sequence != sequence:
+            # this message's block is gone and the oldest one is a later message's (possibly another channel's) -
+            # leave that for its own message rather than publish it under this topic
+            logger.warning(f"waveform block sequence mismatch: expected {sequence}, found {ring_sequence} - dropped")
+            self.metrics.count("waveform_dropped")
+            return
+        logger.debug(f'pub topic:{topic} waveform block:{ring_sequence} ({len(block)} samples)')
+        self.publish(client, topic, block.astype('<i4', copy=False).tobytes(), store=False)
+        self.ring.release()